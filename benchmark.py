@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pwdsync.fastjson as fastjson
+import pwdsync.exporters as exporters
+import pwdsync.importers as importers
+from pwdsync.crypto import SALT_SIZE, gen_key
+from pwdsync.config import config
+from pwdsync.history_events import EditEvent, HistoryEvent, merge_histories
+from pwdsync.history_index import HistoryIndex
+from pwdsync.password import Password
+from pwdsync.storage import Storage, from_json, kdf_params, preload_vault, read_lines, to_json
+
+BENCH_PASSWORD = "benchmark"
+CATEGORY_SIZE = 100
+PAGE_SIZE = 20
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def use_cheap_kdf():
+    config.config.update(kdf_n=2 ** 14, kdf_r=8, kdf_p=1)
+
+
+def make_storage(entries):
+    storage = Storage()
+    storage.load_data(BENCH_PASSWORD, os.devnull)
+    for i in range(entries):
+        pwd = Password("entry{}".format(i), "user{}".format(i), "secret{:016x}".format(i), comment="generated")
+        storage.add_pwd(pwd, "group{}".format(i // CATEGORY_SIZE))
+    return storage
+
+
+def run_child(*args):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__)] + [str(arg) for arg in args])
+    return output.decode().split()
+
+
+def stream_child(mode, entries, path):
+    use_cheap_kdf()
+    if mode == "save":
+        storage = make_storage(entries)
+        before = peak_rss()
+        start = time.perf_counter()
+        storage.save_data(path)
+        print(before, peak_rss(), time.perf_counter() - start)
+    else:
+        before = peak_rss()
+        start = time.perf_counter()
+        Storage().load_data(BENCH_PASSWORD, path)
+        print(before, peak_rss(), time.perf_counter() - start)
+
+
+def bench_stream(args):
+    if args.child:
+        return stream_child(args.child, args.entries[0], args.path)
+
+    print("{:>10} {:>10} {:>12} {:>12} {:>8} {:>12} {:>8}".format(
+        "entries", "file MiB", "tree MiB", "save peak", "save s", "load peak", "load s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "passwords")
+        for entries in args.entries:
+            tree, save_peak, save_time = map(float, run_child("stream", "--child", "save", "--path", path, entries))
+            _, load_peak, load_time = map(float, run_child("stream", "--child", "load", "--path", path, entries))
+            print("{:>10} {:>10.1f} {:>12.1f} {:>12.1f} {:>8.2f} {:>12.1f} {:>8.2f}".format(
+                entries, os.path.getsize(path) / 2 ** 20, tree, save_peak, save_time, load_peak, load_time))
+
+
+def bench_save(args):
+    use_cheap_kdf()
+    print("{:>10} {:>12} {:>14}".format("entries", "snapshot s", "one edit ms"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "passwords")
+        for entries in args.entries:
+            storage = make_storage(entries)
+            start = time.perf_counter()
+            storage.save_data(path)
+            snapshot_time = time.perf_counter() - start
+
+            times = []
+            for i in range(args.repeat):
+                storage.edit_pwd("comment", "edit {}".format(i), "group0", "entry0")
+                start = time.perf_counter()
+                storage.save_data(path)
+                times.append(time.perf_counter() - start)
+            print("{:>10} {:>12.2f} {:>14.3f}".format(entries, snapshot_time, 1000 * sorted(times)[len(times) // 2]))
+
+
+def make_history(events, offset):
+    return [EditEvent(["group{}".format(i // CATEGORY_SIZE)], "entry{}".format(i), "comment", "change {}".format(i),
+                      1500000000 + i) for i in range(offset, offset + events)]
+
+
+def bench_merge(args):
+    print("{:>10} {:>12} {:>12} {:>12} {:>12}".format("events", "set+sort s", "linear s", "new remote", "new local"))
+    for events in args.events:
+        # both sides share the first half of their history
+        local = make_history(events, 0)
+        remote = local[:events // 2] + make_history(events - events // 2, events)
+
+        start = time.perf_counter()
+        sorted(set(local + remote))
+        set_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = merge_histories(local, remote)
+        linear_time = time.perf_counter() - start
+        print("{:>10} {:>12.3f} {:>12.3f} {:>12} {:>12}".format(
+            events, set_time, linear_time, result.new_remote, result.new_local))
+
+
+def bench_memory(args):
+    use_cheap_kdf()
+    print("{:>10} {:>12} {:>14}".format("events", "loaded MiB", "bytes/event"))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "passwords")
+        for events in args.events:
+            # half of the events add passwords, the other half edits a tenth of them
+            entries = events // 2
+            storage = make_storage(entries)
+            for i in range(events - entries):
+                entry = i % max(entries // 10, 1)
+                storage.edit_pwd("comment", "edit {}".format(i), "group{}".format(entry // CATEGORY_SIZE),
+                                 "entry{}".format(entry))
+            storage.save_data(path)
+            del storage
+
+            tracemalloc.start()
+            storage = Storage()
+            storage.load_data(BENCH_PASSWORD, path)
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{:>10} {:>12.1f} {:>14.0f}".format(events, size / 2 ** 20, size / events))
+
+
+def object_hook(dct):
+    # how documents were decoded before the schema aware loader
+    if "password" in dct:
+        return Password.from_json(dct)
+    elif "event" in dct:
+        return HistoryEvent.from_json(dct)
+    return dct
+
+
+class JsonEncoder(json.JSONEncoder):
+    def default(self, obj):
+        return obj.to_json()
+
+
+def timed(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def bench_json(args):
+    use_cheap_kdf()
+    print("backend: " + fastjson.BACKEND)
+    print("{:>10} {:>10} {:>12} {:>10} {:>12} {:>12} {:>12}".format(
+        "entries", "old dump", "to_json", "old load", "from_json", "dump lines", "load lines"))
+    for entries in args.entries:
+        storage = make_storage(entries)
+        data = {"history": storage.history, "passwords": storage.passwords}
+
+        _, old_dump = timed(JsonEncoder().encode, data)
+        text, new_dump = timed(to_json, data)
+        _, old_load = timed(lambda: json.loads(text, object_hook=object_hook))
+        _, new_load = timed(from_json, text.encode())
+        lines, dump_lines = timed(lambda: b"".join(storage.iter_records()))
+        _, load_lines = timed(lambda: Storage().load_records(read_lines([lines])))
+        print("{:>10} {:>10.2f} {:>12.2f} {:>10.2f} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+            entries, old_dump, new_dump, old_load, new_load, dump_lines, load_lines))
+
+
+def bench_search(args):
+    use_cheap_kdf()
+    storage = make_storage(args.entries)
+    _, build = timed(storage.search, "warmup", repeat=1)
+    print("{} entries, index built in {:.2f} s".format(args.entries, build))
+    print("{:>16} {:>10} {:>12}".format("query", "results", "ms/query"))
+    for query in args.queries:
+        results, seconds = timed(storage.search, query, args.limit or None, repeat=args.repeat)
+        print("{:>16} {:>10} {:>12.3f}".format(query, len(results), seconds * 1000))
+
+
+def nested_lookup(storage, *path):
+    # how get_pwd walked the tree before the path index
+    pwd = storage.get_category(*path[:-1]).get(path[-1])
+    return pwd if isinstance(pwd, Password) else None
+
+
+def sorted_walk(category, path=()):
+    # how listings sorted every level before the path index
+    for key in sorted(category):
+        value = category[key]
+        if isinstance(value, Password):
+            yield path + (key,), value
+        else:
+            yield from sorted_walk(value, path + (key,))
+
+
+def bench_paths(args):
+    use_cheap_kdf()
+    print("{:>10} {:>12} {:>12} {:>12} {:>12}".format("entries", "walk us", "index us", "sort list s", "index list s"))
+    for entries in args.entries:
+        storage = make_storage(entries)
+        paths = [("group{}".format(i // CATEGORY_SIZE), "entry{}".format(i)) for i in range(0, entries, 7)]
+        storage.get_pwd(*paths[0])
+
+        _, walk = timed(lambda: [nested_lookup(storage, *path) for path in paths])
+        _, index = timed(lambda: [storage.get_pwd(*path) for path in paths])
+        _, sort_list = timed(lambda: list(sorted_walk(storage.passwords)))
+        _, index_list = timed(lambda: list(storage.iter_category()))
+        print("{:>10} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+            entries, walk / len(paths) * 1e6, index / len(paths) * 1e6, sort_list, index_list))
+
+
+def bench_history(args):
+    print("{:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "events", "index s", "scan ms", "entry ms", "group ms", "key ms", "day ms"))
+    for events in args.events:
+        # edits of a thousand entries in groups of CATEGORY_SIZE, one event a minute
+        keys = ("comment", "username", "password")
+        history = [EditEvent(["group{}".format(i % 1000 // CATEGORY_SIZE)], "entry{}".format(i % 1000), keys[i % 3],
+                             "change {}".format(i), 1500000000 + i * 60, id=str(i)) for i in range(events)]
+        index, build = timed(lambda: HistoryIndex(history), repeat=1)
+        day = 1500000000 + events // 2 * 60
+        # a page of results, like the history command shows them
+        queries = [
+            lambda: [event for event in history[::-1] if event.name == "entry7"][:PAGE_SIZE],
+            lambda: list(itertools.islice(index.query("group0/entry7"), PAGE_SIZE)),
+            lambda: list(itertools.islice(index.query("group1"), PAGE_SIZE)),
+            lambda: list(itertools.islice(index.query("group2/entry250", key="password"), PAGE_SIZE)),
+            lambda: list(itertools.islice(index.query(since=day, until=day + 24 * 60 * 60), PAGE_SIZE))
+        ]
+        print("{:>10} {:>10.2f}".format(events, build) + "".join(
+            " {:>10.3f}".format(timed(query)[1] * 1000) for query in queries))
+
+
+def write_export(path, format, entries):
+    # what the managers export, written a row at a time
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if format == "csv":
+            f.write("folder,name,login_username,login_password,login_uri,notes\r\n")
+            for i in range(entries):
+                f.write("group{},entry{},user{},secret{:016x},https://example.com/{},generated\r\n".format(
+                    i // CATEGORY_SIZE, i, i, i, i))
+        elif format == "keepass":
+            f.write("<KeePassFile><Meta/><Root><Group><Name>Database</Name>")
+            for i in range(entries):
+                if i % CATEGORY_SIZE == 0:
+                    f.write("</Group>" if i else "")
+                    f.write("<Group><Name>group{}</Name>".format(i // CATEGORY_SIZE))
+                f.write("<Entry><String><Key>Title</Key><Value>entry{0}</Value></String><String><Key>UserName</Key>"
+                        "<Value>user{0}</Value></String><String><Key>Password</Key><Value>secret{0:016x}</Value>"
+                        "</String><String><Key>Notes</Key><Value>generated</Value></String></Entry>".format(i))
+            f.write("</Group>" if entries else "")
+            f.write("</Group></Root></KeePassFile>")
+        else:
+            folders = [{"id": str(i), "name": "group{}".format(i)} for i in range((entries - 1) // CATEGORY_SIZE + 1)]
+            f.write('{"encrypted": false, "folders": ' + json.dumps(folders) + ', "items": [')
+            for i in range(entries):
+                f.write((", " if i else "") + json.dumps({
+                    "type": 1, "name": "entry{}".format(i), "folderId": str(i // CATEGORY_SIZE), "notes": "generated",
+                    "login": {"username": "user{}".format(i), "password": "secret{:016x}".format(i)}}))
+            f.write("]}")
+
+
+def bench_import(args):
+    use_cheap_kdf()
+    print("{:>10} {:>10} {:>12} {:>14} {:>14}".format("format", "entries", "parse /s", "parse peak MiB", "import /s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for format in args.formats:
+            for entries in args.entries:
+                path = os.path.join(tmp, "export")
+                write_export(path, format, entries)
+
+                tracemalloc.start()
+                start = time.perf_counter()
+                for _ in importers.read_entries(path, format):
+                    pass
+                parse_time = time.perf_counter() - start
+                _, parse_peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                storage = make_storage(0)
+                start = time.perf_counter()
+                importers.import_file(storage, path, format)
+                import_time = time.perf_counter() - start
+                print("{:>10} {:>10} {:>12.0f} {:>14.2f} {:>14.0f}".format(
+                    format, entries, entries / parse_time, parse_peak / 2 ** 20, entries / import_time))
+
+
+def bench_export(args):
+    use_cheap_kdf()
+    print("{:>10} {:>10} {:>12} {:>9}".format("format", "entries", "export /s", "peak MiB"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for entries in args.entries:
+            storage = make_storage(entries)
+            # the path index is built once per vault and not part of the export
+            storage.get_path_index()
+            for format in args.formats:
+                path = os.path.join(tmp, "export")
+                start = time.perf_counter()
+                exporters.export_file(storage, path, format=format)
+                export_time = time.perf_counter() - start
+
+                tracemalloc.start()
+                exporters.export_file(storage, path, format=format)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print("{:>10} {:>10} {:>12.0f} {:>9.2f}".format(format, entries, entries / export_time, peak / 2 ** 20))
+
+
+def import_time():
+    code = "import time; start = time.perf_counter(); import cli; print(time.perf_counter() - start)"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(output)
+
+
+def bench_startup(args):
+    if args.kdf_n:
+        config.config.update(kdf_n=args.kdf_n)
+    params = kdf_params()
+    print("{} entries, scrypt N={}, r={}, p={}{}".format(
+        args.entries, params.n, params.r, params.p, ", armored" if args.armor else ""))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "passwords")
+        make_storage(args.entries).write_snapshot(path, args.armor)
+
+        _, imports = timed(import_time)
+        preloaded, preload = timed(preload_vault, path)
+        _, kdf = timed(gen_key, BENCH_PASSWORD, bytes(SALT_SIZE), params)
+        _, sequential = timed(lambda: Storage().load_data(BENCH_PASSWORD, path))
+        _, after_enter = timed(lambda: Storage().load_data(BENCH_PASSWORD, path, preloaded))
+
+    print("{:>32} {:>8.3f}".format("imports", imports))
+    print("{:>32} {:>8.3f}".format("read, decode, check header", preload))
+    print("{:>32} {:>8.3f}".format("key derivation", kdf))
+    print("{:>32} {:>8.3f}".format("decrypt and parse", after_enter - kdf))
+    print("{:>32} {:>8.3f}".format("after Enter, sequential", sequential))
+    print("{:>32} {:>8.3f}".format("after Enter, preloaded", after_enter))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PwdSync benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    stream = subparsers.add_parser("stream", help="Peak RSS of saving and loading vaults of growing size")
+    stream.add_argument("entries", nargs="*", type=int, default=[10000, 100000, 1000000])
+    stream.add_argument("--child", choices=("save", "load"), help=argparse.SUPPRESS)
+    stream.add_argument("--path", help=argparse.SUPPRESS)
+    stream.set_defaults(func=bench_stream)
+
+    save = subparsers.add_parser("save", help="Cost of saving a single edit for vaults of growing size")
+    save.add_argument("entries", nargs="*", type=int, default=[10, 1000, 100000])
+    save.add_argument("--repeat", type=int, default=20)
+    save.set_defaults(func=bench_save)
+
+    merge = subparsers.add_parser("merge", help="Merging two histories of growing size")
+    merge.add_argument("events", nargs="*", type=int, default=[1000, 10000, 100000])
+    merge.set_defaults(func=bench_merge)
+
+    memory = subparsers.add_parser("memory", help="Memory used by a loaded vault")
+    memory.add_argument("events", nargs="*", type=int, default=[100000])
+    memory.set_defaults(func=bench_memory)
+
+    json_parser = subparsers.add_parser("json", help="Encoding and decoding vaults with the stdlib and fast paths")
+    json_parser.add_argument("entries", nargs="*", type=int, default=[10000, 100000])
+    json_parser.set_defaults(func=bench_json)
+
+    search = subparsers.add_parser("search", help="Query times of the search index")
+    search.add_argument("queries", nargs="*", default=["entry4242", "user1234", "4999", "group7", "us", "nothing"])
+    search.add_argument("--entries", type=int, default=50000)
+    search.add_argument("--repeat", type=int, default=20)
+    search.add_argument("--limit", type=int, default=20, help="best matches to return, 0 for all of them")
+    search.set_defaults(func=bench_search)
+
+    paths = subparsers.add_parser("paths", help="Password lookups and listings with and without the path index")
+    paths.add_argument("entries", nargs="*", type=int, default=[1000, 100000])
+    paths.set_defaults(func=bench_paths)
+
+    import_parser = subparsers.add_parser("import", help="Throughput and memory of importing exports of growing size")
+    import_parser.add_argument("entries", nargs="*", type=int, default=[1000, 10000, 100000])
+    import_parser.add_argument("--formats", nargs="+", choices=("bitwarden", "csv", "keepass"),
+                               default=["bitwarden", "csv", "keepass"])
+    import_parser.set_defaults(func=bench_import)
+
+    export = subparsers.add_parser("export", help="Throughput and memory of plaintext exports of growing vaults")
+    export.add_argument("entries", nargs="*", type=int, default=[1000, 10000, 100000])
+    export.add_argument("--formats", nargs="+", choices=sorted(exporters.FORMATS), default=sorted(exporters.FORMATS))
+    export.set_defaults(func=bench_export)
+
+    history = subparsers.add_parser("history", help="Building the history index and querying it")
+    history.add_argument("events", nargs="*", type=int, default=[10000, 100000, 1000000])
+    history.set_defaults(func=bench_history)
+
+    startup = subparsers.add_parser("startup", help="Where the time between starting the CLI and the first prompt goes")
+    startup.add_argument("entries", nargs="?", type=int, default=10000)
+    startup.add_argument("--armor", action="store_true")
+    startup.add_argument("--kdf-n", type=int, help="scrypt N, defaults to the configured one")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,227 @@
 #!/usr/bin/env python3
 
-import traceback
-
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+
+import pwdsync.agent as agent
 import pwdsync.crypto as crypto
 import pwdsync.utils as utils
 import pwdsync.clipboard as clipboard
 import pwdsync.exceptions as exceptions
 import pwdsync.terminal as terminal
 from pwdsync.config import config
-from pwdsync.storage import Password, storage, Storage
+from pwdsync.history_index import parse_time
+from pwdsync.password import SECRET_FIELDS
+from pwdsync.storage import Password, storage, Storage, kdf_params, preload_vault, vault_stat
+from pwdsync.trie import Trie
+
+subprocess = utils.lazy_import("subprocess")
+traceback = utils.lazy_import("traceback")
+sync = utils.lazy_import("pwdsync.sync")
+importers = utils.lazy_import("pwdsync.importers")
+exporters = utils.lazy_import("pwdsync.exporters")
+IMPORT_TIME_PREFIX = "import time:"
+
+# the passwords are evicted from memory once the prompt was idle for lock_timeout seconds
+lock_timer = None
+lock_mutex = threading.Lock()
+
+
+def preload():
+    crypto.load_backend()
+    clipboard.load_backend()
+    return preload_vault()
+
+
+def load_data(preloaded=None):
+    terminal.ask_pwd(lambda pwd: storage.load_data(pwd, preloaded=preloaded and preloaded.result()))
+
+
+def build_indexes():
+    # while the prompt waits for the first command. Not for one-shot commands, the agent is forked after loading
+    # and the thread wouldn't survive it
+    storage.build_search_index_in_background()
+
+
+def schedule_lock():
+    global lock_timer
+    if config.lock_timeout > 0:
+        lock_timer = threading.Timer(config.lock_timeout, auto_lock)
+        lock_timer.daemon = True
+        lock_timer.start()
+
+
+def cancel_lock():
+    if lock_timer is not None:
+        lock_timer.cancel()
+
 
+def auto_lock():
+    with lock_mutex:
+        if not storage.locked:
+            storage.evict()
 
-def load_data():
-    terminal.ask_pwd(storage.load_data)
+
+def lock():
+    storage.evict()
+
+
+def unlock():
+    terminal.respond("The passwords are locked")
+    terminal.ask_pwd(storage.unlock)
+    build_indexes()
+    terminal.success("Unlocked in {:.0f} ms".format(storage.timings["unlock"] * 1000))
+    print()
+
+
+def show_stats():
+    terminal.respond("Passwords: {}".format(len(storage.get_path_index().passwords)))
+    terminal.respond("History events: {}".format(len(storage.history)))
+    for name, description in (("load", "Load"), ("save", "Last save"), ("fsync", "Last save fsync"),
+                              ("lock", "Last lock"), ("unlock", "Last unlock")):
+        if name in storage.timings:
+            terminal.respond("{}: {:.1f} ms".format(description, storage.timings[name] * 1000))
 
 
 def save_data():
     storage.save_data()
-    terminal.success("Passwords saved")
+    terminal.success("Passwords saved in {:.0f} ms ({:.0f} ms fsync)".format(
+        storage.timings["save"] * 1000, storage.timings["fsync"] * 1000))
 
 
-def flash_pwd(*pwd):
-    pwd = storage.get_pwd(*pwd)
-    if pwd is None:
+def save_in_background():
+    # failures are reported before the next prompt
+    storage.save_in_background()
+    terminal.success("Saving passwords")
+
+
+def report_save_errors():
+    if storage.saver is None:
+        return False
+    errors = storage.saver.pop_errors()
+    for error in errors:
+        terminal.error("Saving failed: " + str(error))
+    return bool(errors)
+
+
+def quit_pwdsync():
+    if storage.saver is not None:
+        storage.saver.flush()
+    if report_save_errors() and not terminal.ask_yes_no("Quit without saving?", False):
+        return
+    terminal.goodbye()
+
+
+MAX_SHOWN_MATCHES = 10
+MAX_SEARCH_RESULTS = 20
+
+
+def resolve_pwd(*pwd):
+    matches = storage.find_pwds("/".join(part.strip("/") for part in pwd))
+    if len(matches) == 1:
+        return matches[0]
+
+    if not matches:
         terminal.error("No such password")
     else:
-        terminal.flash(pwd.password)
+        shown = ", ".join("/".join(path) for path in matches[:MAX_SHOWN_MATCHES])
+        if len(matches) > MAX_SHOWN_MATCHES:
+            shown += ", ..."
+        terminal.error("Multiple matching passwords: {white}" + shown)
+    return None
+
+
+def flash_pwd(*pwd):
+    path = resolve_pwd(*pwd)
+    if path is not None:
+        terminal.flash(storage.reveal(storage.get_pwd(*path)))
+
+
+def get_field(*pwd, field="password"):
+    path = resolve_pwd(*pwd)
+    if path is None:
+        return
+    if field not in Password.__slots__:
+        return terminal.error("Invalid field name: **{}**".format(field))
+    value = storage.reveal(storage.get_pwd(*path), field)
+    if value is not None:
+        print(value)
 
 
 def list_passwords(*categories):
-    pwds = storage.get_category(*categories)
-    print_recursively(pwds)
-
-
-def print_recursively(data, indentation=0):
-    for key in sorted(data.keys()):
-        value = data[key]
-        if isinstance(value, Password):
-            terminal.respond(" " * indentation + str(value))
-        elif isinstance(value, dict):
-            terminal.respond(" " * indentation + key)
-            print_recursively(value, indentation + 2)
-            print()
+    if storage.list_category(*categories) is None:
+        terminal.error("No such category")
+        return
+    print_recursively(categories)
+
+
+def print_recursively(categories, indentation=0):
+    for name, pwd in storage.list_category(*categories):
+        if pwd is not None:
+            terminal.respond(" " * indentation + str(pwd))
         else:
-            raise ValueError("Invalid data type in pwd dict: " + type(value))
+            terminal.respond(" " * indentation + name)
+            print_recursively(categories + (name,), indentation + 2)
+            print()
+
+
+def search(keyword):
+    # one more than is shown, to know whether there are more
+    paths = storage.search(keyword, MAX_SEARCH_RESULTS + 1)
+    if not paths:
+        terminal.error("No matching passwords")
+        return
+
+    for path in paths[:MAX_SEARCH_RESULTS]:
+        pwd = storage.get_pwd(*path)
+        terminal.respond("**{}**\t\t{}".format(" ".join(path), pwd.username))
+    if len(paths) > MAX_SEARCH_RESULTS:
+        terminal.respond("Only the best {} matches are shown, use a longer keyword to narrow them down".format(
+            MAX_SEARCH_RESULTS), "yellow")
+
+
+def show_history(*path, since=None, until=None, key=None):
+    path = [part.strip("/") for part in path if part.strip("/")]
+    if key is not None and key not in Password.__slots__:
+        terminal.error("No such field **{}**".format(key))
+        return
+    try:
+        since = None if since is None else parse_time(since)
+        until = None if until is None else parse_time(until, end=True)
+    except ValueError:
+        terminal.error("Invalid time. Use an age like **7d**, a date like **2020-01-31** or **2020-01-31T12:00**")
+        return
+
+    shown = 0
+    for event in storage.query_history(*path, since=since, until=until, key=key):
+        if shown and shown % config.history_page_size == 0 and not terminal.ask_yes_no("Show older changes?"):
+            return
+        terminal.respond(describe_event(event))
+        shown += 1
+    if not shown:
+        terminal.error("No matching changes")
+
+
+def describe_event(event):
+    when = time.strftime("%Y-%m-%d %H:%M", time.localtime(event.time))
+    path = "/".join(filter(None, (event.categories, event.name)))
+    if event.event == "ADD":
+        return "{}  **{}**  added with username {}".format(when, path, event.pwd.username or "-")
+    # secrets are sealed in the history and never shown
+    value = "[hidden]" if event.key in SECRET_FIELDS else event.value
+    return "{}  **{}**  {}: {}".format(when, path, event.key, value)
 
 
 def copy_pwd(*pwd):
     try:
-        pwd = storage.get_pwd(*pwd)
-        if not pwd:
-            return terminal.error("No such password")
-        clipboard.copy(pwd.password)
+        path = resolve_pwd(*pwd)
+        if path is None:
+            return
+        clipboard.copy(storage.reveal(storage.get_pwd(*path)))
         terminal.success("Copyed to clipboard")
     except KeyError:
         terminal.error("No such password")
@@ -83,11 +253,14 @@ def add_pwd():
 
     print()
     if terminal.ask_yes_no("Do you want to save?"):
-        save_data()
+        save_in_background()
 
 
 def show_pwd(*pwd):
-    pwd = storage.get_pwd(*pwd)
+    path = resolve_pwd(*pwd)
+    if path is None:
+        return
+    pwd = storage.get_pwd(*path)
     terminal.respond(pwd.name)
     terminal.respond("Username: {}".format(pwd.username))
     terminal.respond("Password: [hidden]")
@@ -97,6 +270,9 @@ def show_pwd(*pwd):
 
 
 def edit_pwd(*pwd_path):
+    pwd_path = resolve_pwd(*pwd_path)
+    if pwd_path is None:
+        return
     show_pwd(*pwd_path)
     changes = False
 
@@ -126,34 +302,151 @@ def edit_pwd(*pwd_path):
             terminal.error("Invalid field name: **{}**".format(key))
 
     if changes and terminal.ask_yes_no("Do you want to save?"):
+        save_in_background()
+
+
+def rekey():
+    new_pwd = terminal.get_pass("Enter new password:")
+    if new_pwd != terminal.get_pass("Repeat new password:"):
+        terminal.error("The passwords don't match")
+        return
+    storage.rekey(new_pwd)
+    save_data()
+
+
+def calibrate(target_time=None):
+    target_time = float(target_time) if target_time else config.kdf_target_time
+    terminal.respond("Measuring key derivation speed...")
+    params = crypto.calibrate(target_time, config.kdf_max_memory * 1024 * 1024)
+    config.update(kdf_n=params.n, kdf_r=params.r, kdf_p=params.p)
+    terminal.success("Using scrypt N={}, r={}, p={} (**{} MiB**)".format(
+        params.n, params.r, params.p, crypto.kdf_memory(params) // (1024 * 1024)))
+
+    print()
+    if terminal.ask_yes_no("Do you want to re-encrypt the passwords with the new parameters?"):
+        terminal.ask_pwd(reencrypt, "Enter current password:")
+        save_data()
+
+
+def reencrypt(pwd):
+    storage.check_pwd(pwd)
+    storage.rekey(pwd)
+
+
+def export(path, *categories, format=None, armor=False, encrypt=False):
+    if format is None:
+        if categories or encrypt:
+            return terminal.error("Exporting categories or with a passphrase needs **--format**")
+        storage.write_snapshot(path, armor)
+        terminal.success("Exported passwords to **{}**".format(path))
+        return
+    if format not in exporters.FORMATS:
+        return terminal.error("Invalid format **{}**, use one of {}".format(format, ", ".join(exporters.FORMATS)))
+    if storage.list_category(*categories) is None:
+        return terminal.error("No such category")
+
+    session = None
+    if encrypt:
+        passphrase = terminal.get_pass("Enter a passphrase for the export:")
+        if passphrase != terminal.get_pass("Repeat the passphrase:"):
+            return terminal.error("The passphrases don't match")
+        session = crypto.KeySession()
+        session.unlock(crypto.sha256(passphrase), params=kdf_params())
+    try:
+        count = exporters.export_file(storage, path, categories, format, session, armor)
+    finally:
+        if session is not None:
+            session.lock()
+    terminal.success("Exported **{}** passwords to **{}**".format(count, path))
+    if session is None:
+        terminal.respond("The file contains the passwords in plaintext", "yellow")
+
+
+def import_pwds(path, format=None):
+    results = []
+    if importers.is_encrypted(path):
+        terminal.ask_pwd(lambda passphrase: results.append(importers.import_file(storage, path, format, passphrase)),
+                         "Enter the passphrase of the export:")
+    else:
+        results.append(importers.import_file(storage, path, format))
+    result = results[0]
+    terminal.success("Imported **{}** passwords from {}".format(result.added, path))
+    if result.skipped:
+        terminal.respond("Skipped {} passwords that are already here".format(result.skipped))
+    if result.renamed:
+        terminal.respond("Renamed {} passwords whose name was taken".format(result.renamed))
+    if result.added:
         save_data()
 
 
 def merge(path):
     to_merge = Storage()
     terminal.ask_pwd(lambda pwd: to_merge.load_data(pwd, path))
-    storage.merge(to_merge)
+    result = storage.merge(to_merge)
+    terminal.success("Merged **{}** new events from {} (**{}** events were only here)".format(
+        result.new_remote, path, result.new_local))
+    report_conflicts(result.conflicts)
+
+
+def report_conflicts(conflicts):
+    for conflict in conflicts:
+        terminal.respond("Conflicting changes of **{}** of **{}**: kept the one from device {} over {}".format(
+            conflict.key or "the entry", "/".join(filter(None, conflict.path)), conflict.winner.device or "unknown",
+            conflict.loser.device or "unknown"), "yellow")
+
+
+def sync_passwords(server=None):
+    address = server or config.sync_server
+    account = sync.fetch_account(address)
+    results = []
+
+    def run(pwd):
+        if account is None:
+            # the first sync creates the account, its password has to be the master password
+            storage.check_pwd(pwd)
+        results.append(sync.sync(storage, address, pwd, account))
+    terminal.ask_pwd(run)
+    result = results[0]
+    terminal.success("Pulled **{}** and pushed **{}** events ({:.1f} KiB sent, {:.1f} KiB received)".format(
+        result.pulled, result.pushed, result.sent / 1024, result.received / 1024))
+    report_conflicts(result.conflicts)
+
+
+def compact(retention_days=None):
+    retention_days = int(retention_days) if retention_days else config.history_retention_days
+    count = storage.compact(retention_days)
+    if count == 0:
+        terminal.respond("No history older than {} days".format(retention_days))
+        return
+
+    terminal.success("Folded {} history events into the checkpoint".format(count))
+    print()
+    if terminal.ask_yes_no("Do you want to save?"):
+        save_in_background()
 
 
 class CommandParser:
     def __init__(self):
         self.commands = {}
+        self.command_trie = Trie()
         self.add_command(
             ["h", "help", "?"],
             "Show this help",
             self.show_help
         )
 
-    def add_command(self, names, description, fun=None, args=()):
+    def add_command(self, names, description, fun=None, args=(), one_shot=False):
         if isinstance(args, str):
             args = args.split(" ")
         if isinstance(names, str):
             names = [names]
-        min_count, max_count = self.get_min_max(args)
+        options = self.get_options(args)
+        min_count, max_count = self.get_min_max([arg for arg in args if arg.strip("[")[:2] != "--"])
 
-        data = [description, args, names, fun, min_count, max_count]
+        data = [description, args, names, fun, min_count, max_count, options, one_shot]
         for name in names:
             self.commands[name] = data
+            self.command_trie.add(name)
 
     def get_min_max(self, args):
         min_count = 0
@@ -161,12 +454,11 @@ class CommandParser:
         for arg in args:
             if arg[0] == "[" and arg[-1] == "]":
                 if arg[1] == "*":
-                    min_count = 0
                     max_count = float("inf")
                     break
                 max_count += 1
             elif arg[0] == "*":
-                min_count = 1
+                min_count += 1
                 max_count = float("inf")
                 break
             else:
@@ -174,6 +466,38 @@ class CommandParser:
                 max_count += 1
         return min_count, max_count
 
+    def get_options(self, args):
+        options = {}
+        for arg in args:
+            arg = arg.strip("[]")
+            if arg.startswith("--"):
+                name, sep, _ = arg[2:].partition("=")
+                options[name] = bool(sep)
+        return options
+
+    def parse_options(self, command, args, options):
+        kwargs = {}
+        positional = []
+        args = iter(args)
+        for arg in args:
+            if not arg.startswith("--"):
+                positional.append(arg)
+                continue
+
+            name, sep, value = arg[2:].partition("=")
+            if name not in options:
+                terminal.error("**{}** has no option **--{}**".format(command, name))
+                return None, None
+            if not options[name]:
+                value = True
+            elif not sep:
+                value = next(args, None)
+                if value is None:
+                    terminal.error("**--{}** expects a value".format(name))
+                    return None, None
+            kwargs[name.replace("-", "_")] = value
+        return positional, kwargs
+
     def show_help(self):
         terminal.respond("Available commands:\n")
 
@@ -196,33 +520,62 @@ class CommandParser:
             cmd_str, description = commands[cmd]
             terminal.respond(fmt_str.format(cmd_str, description))
 
+    def find_commands(self, action):
+        # exact name, else names it is a prefix of, else fuzzy matches. Aliases of one command count once
+        if action in self.commands:
+            return [action]
+        matches = list(self.command_trie.complete(action)) or list(self.command_trie.fuzzy(action))
+        commands = {}
+        for name in matches:
+            commands.setdefault(self.commands[name][2][0], name)
+        return list(commands.values())
+
+    def complete(self, line, word):
+        words = line.split()
+        if not words:
+            return list(self.command_trie.complete(word))
+
+        commands = self.find_commands(words[0])
+        if len(commands) != 1:
+            return []
+        args = self.commands[commands[0]][1]
+        if not any("PWD" in arg or "CATEGORIES" in arg or "PATH" in arg for arg in args):
+            return []
+
+        head = "/".join(arg.strip("/") for arg in words[1:] if not arg.startswith("--"))
+        prefix = head + "/" + word if head else word
+        return [path[len(prefix) - len(word):] for path in storage.complete_path(prefix)]
+
     def parse_command(self, cmd):
         if cmd == "":
             return
         print()
 
         action, *args = cmd.split(" ")
-        command = None
-        if action in self.commands:
-            command = action
-        else:
-            possible_commands = tuple(filter(lambda c: c.startswith(cmd), self.commands))
-            if len(possible_commands) == 1:
-                command = possible_commands[0]
-            elif len(possible_commands) > 1:
-                terminal.error("Multiple possible commands: {white}" + ", ".join(possible_commands))
-            else:
-                terminal.error("Invalid command: **{}**. Use **help** to see all available commands.".format(repr(cmd)))
-
-        if command is None:
-            print()
-            return
+        command = self.resolve_command(action)
+        if command is not None:
+            self.run_command(command, args)
+        print()
 
-        *_, fun, min_count, max_count = self.commands[command]
-        if fun is None:
+    def resolve_command(self, action):
+        possible_commands = self.find_commands(action)
+        if len(possible_commands) == 1:
+            return possible_commands[0]
+        elif len(possible_commands) > 1:
+            terminal.error("Multiple possible commands: {white}" + ", ".join(possible_commands))
+        else:
+            terminal.error("Invalid command: **{}**. Use **help** to see all available commands.".format(repr(action)))
+        return None
+
+    def run_command(self, command, args):
+        *_, fun, min_count, max_count, options, _ = self.commands[command]
+        args, kwargs = self.parse_options(command, args, options)
+        if args is None:
+            pass
+        elif fun is None:
             terminal.error("**{}** is not yet implemented".format(command))
         elif min_count <= len(args) <= max_count:
-            fun(*args)
+            fun(*args, **kwargs)
         elif max_count == float("inf"):
             terminal.error("**{}** expects at least 1 argument but got {}.".format(command, len(args)))
         elif min_count == max_count:
@@ -230,41 +583,74 @@ class CommandParser:
         else:
             terminal.error("**{}** expects between {} and {} arguments but got {}.".format(command,
                                                                                            min_count, max_count, len(args)))
-        print()
 
 
-def main():
-    terminal.logo()
-    load_data()
-
+def make_parser():
     parser = CommandParser()
     parser.add_command("save", "Save the passwords to file", save_data)
-    parser.add_command("sync", "Sync passwords to server")
+    parser.add_command("lock", "Lock the passwords until the master password is entered again", lock)
+    parser.add_command("stats", "Show the size of the database and how long loading, locking and unlocking took",
+                       show_stats, one_shot=True)
+    parser.add_command(["rekey", "passwd"], "Change the master password", rekey)
+    parser.add_command("calibrate", "Tune the key derivation cost to the target unlock time", calibrate, "[SECONDS]")
+    parser.add_command("sync", "Sync passwords with the server from the config or SERVER", sync_passwords,
+                       "[SERVER]")
+    parser.add_command("export", "Export the encrypted passwords. Use --armor for a text file. With --format, export "
+                       "the CATEGORIES as csv, json or jsonl, encrypted with a passphrase if --encrypt is given",
+                       export, "FILE [*CATEGORIES] [--format=FORMAT] [--armor] [--encrypt]")
     parser.add_command("merge", "Merge another pwd database", merge, "FILE")
+    parser.add_command("import", "Import a CSV, KeePass XML or Bitwarden JSON export. FORMAT is csv, keepass or "
+                       "bitwarden", import_pwds, "FILE [--format=FORMAT]")
+    parser.add_command("compact", "Fold history older than the retention window into a checkpoint", compact, "[DAYS]")
     parser.add_command(["pwd", "flash"], "Show the password", flash_pwd, "*PWD")
-    parser.add_command("show", "Show the password metadata", show_pwd, "*PWD")
-    parser.add_command("list", "List all passwords. Optionally filter by category", list_passwords, "[*CATEGORIES]")
-    parser.add_command("copy", "Copy the password to clipboard", copy_pwd, "*PWD")
+    parser.add_command("show", "Show the password metadata", show_pwd, "*PWD", one_shot=True)
+    parser.add_command("get", "Print a field of the password, the password itself by default", get_field,
+                       "*PWD [--field=NAME]", one_shot=True)
+    parser.add_command("list", "List all passwords. Optionally filter by category", list_passwords, "[*CATEGORIES]",
+                       one_shot=True)
+    parser.add_command("copy", "Copy the password to clipboard", copy_pwd, "*PWD", one_shot=True)
     parser.add_command("add", "Add a new password", add_pwd)
     parser.add_command("edit", "Edit an existing password", edit_pwd, "*PWD")
     parser.add_command(
         ["search", "grep"],
         "Search the password database",
-        args="KEYWORD"
+        search,
+        "KEYWORD",
+        one_shot=True
     )
-    parser.add_command("history", "Show the history of password changes")
+    parser.add_command("history", "Show the changes of the passwords under PATH, newest first. T is an age like 7d or "
+                       "a date, K a field like username", show_history, "[*PATH] [--since=T] [--until=T] [--key=K]")
     parser.add_command(
         ["q", "quit", "exit", "end"],
         "Quit PwdSync",
-        terminal.goodbye
+        quit_pwdsync
     )
+    return parser
 
+
+def main():
+    # the vault is read while the password is typed, so only the key derivation is left after Enter
+    preloaded = utils.BackgroundCall(preload)
+    terminal.logo()
+    load_data(preloaded)
+    build_indexes()
+
+    parser = make_parser()
     while True:
-        command = terminal.ask("What do you want to do?")
+        report_save_errors()
+        schedule_lock()
+        command = terminal.ask("What do you want to do?", parser.complete)
+        cancel_lock()
         if command is None:
-            terminal.goodbye()
+            quit_pwdsync()
+            continue
         try:
-            parser.parse_command(command)
+            with lock_mutex:
+                if storage.locked:
+                    unlock()
+                parser.parse_command(command)
+                if storage.locked:
+                    unlock()
         except Exception as e:
             print()
             terminal.error("Error: " + str(e))
@@ -276,5 +662,110 @@ def main():
             print()
 
 
+def run_captured(parser, argv):
+    # runs a command with its output captured, so the agent can send it back
+    terminal.init_colors()
+    output = io.StringIO()
+    errors = terminal.error_count
+    with contextlib.redirect_stdout(output):
+        command = parser.resolve_command(argv[0])
+        if command is not None:
+            try:
+                parser.run_command(command, argv[1:])
+            except Exception as e:
+                terminal.error("Error: " + str(e))
+    return {"status": 1 if terminal.error_count > errors else 0, "output": output.getvalue()}
+
+
+def agent_handler(parser):
+    loaded = [vault_stat()]
+
+    def handle(message):
+        if message.get("command") != agent.RUN:
+            return {"status": 1, "output": "Unknown request\n"}
+        if vault_stat() != loaded[0]:
+            # changed by another process, the key still works unless the master password was changed
+            try:
+                storage.load_data(None)
+            except exceptions.PwdSyncException:
+                return None
+            loaded[0] = vault_stat()
+        return run_captured(parser, message["argv"])
+    return handle
+
+
+def run_one_shot(argv):
+    if argv[0] == agent.LOCK:
+        agent.request({"command": agent.LOCK})
+        return 0
+
+    parser = make_parser()
+    with contextlib.redirect_stdout(sys.stderr):
+        command = parser.resolve_command(argv[0])
+    if command is None:
+        return 2
+    if not parser.commands[command][7]:
+        terminal.error("**{}** is only available interactively".format(command))
+        return 2
+
+    message = {"command": agent.RUN, "argv": argv}
+    response = agent.request(message)
+    if response is None or response.get("locked"):
+        with contextlib.redirect_stdout(sys.stderr):
+            load_data(utils.BackgroundCall(preload))
+        if agent.HAS_AGENT and config.lock_timeout > 0:
+            agent.start(agent_handler(parser), config.lock_timeout)
+            response = agent.request(message)
+        else:
+            response = run_captured(parser, argv)
+
+    output = response["output"]
+    sys.stdout.write(output if sys.stdout.isatty() else terminal.strip_colors(output))
+    return response["status"]
+
+
+def profile_startup():
+    # a fresh interpreter, so nothing is already imported
+    code = ("import time; start = time.perf_counter(); import cli; loaded = time.perf_counter(); cli.config.config; "
+            "print(loaded - start, time.perf_counter() - loaded)")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    # a module is listed after everything it imports, one level deeper
+    modules = []
+    children = []
+    interpreter = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith(IMPORT_TIME_PREFIX):
+            continue
+        _, cumulative, name = line[len(IMPORT_TIME_PREFIX):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children.append((int(cumulative) / 1000, name.strip()))
+        elif depth == 0:
+            if name.strip() == "cli":
+                modules = children
+            else:
+                interpreter += int(cumulative) / 1000
+            children = []
+
+    imports, config_time = (float(value) * 1000 for value in result.stdout.split())
+    terminal.respond("Imports of cli.py:\n")
+    for milliseconds, name in sorted(modules, reverse=True):
+        terminal.respond("{:>8.1f} ms  {}".format(milliseconds, name))
+    print()
+    terminal.respond("{:>8.1f} ms  **interpreter startup**".format(interpreter))
+    terminal.respond("{:>8.1f} ms  **all imports of cli.py**".format(imports))
+    terminal.respond("{:>8.1f} ms  **parsing the config**".format(config_time))
+
+
 if __name__ == "__main__":
-    main()
+    if "--profile-startup" in sys.argv[1:]:
+        profile_startup()
+    elif len(sys.argv) > 1:
+        sys.exit(run_one_shot(sys.argv[1:]))
+    else:
+        main()
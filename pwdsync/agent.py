@@ -0,0 +1,123 @@
+import contextlib
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+import pwdsync.utils as utils
+
+AGENT_SOCKET_NAME = "agent.sock"
+HAS_AGENT = hasattr(socket, "AF_UNIX") and hasattr(os, "fork")
+PEERCRED_STRUCT = struct.Struct("3i")
+LOCK = "lock"
+RUN = "run"
+
+
+def socket_path():
+    return utils.get_pwdsync_file(AGENT_SOCKET_NAME)
+
+
+def send(sock, message):
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def receive(sock):
+    data = bytearray()
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data.decode())
+
+
+def request(message):
+    # None if no agent is running
+    if not HAS_AGENT:
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path())
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        send(sock, message)
+        return receive(sock)
+
+
+def is_same_user(conn):
+    if not hasattr(socket, "SO_PEERCRED"):
+        # the socket file is only accessible by its owner anyway
+        return True
+    _, uid, _ = PEERCRED_STRUCT.unpack(conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED_STRUCT.size))
+    return uid == os.getuid()
+
+
+def listen():
+    path = socket_path()
+    if os.path.exists(path):
+        # only called when connecting failed, so it was left behind by an agent that died
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen()
+    return sock
+
+
+def serve(sock, handle, timeout):
+    # handle returns the response to a message or None to stop, the agent also stops after timeout idle seconds
+    path = socket_path()
+    inode = os.stat(path).st_ino
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            sock.settimeout(remaining)
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                return
+            with conn:
+                conn.settimeout(None)
+                if not is_same_user(conn):
+                    continue
+                message = receive(conn)
+                if message is None:
+                    continue
+                response = None if message.get("command") == LOCK else handle(message)
+                send(conn, response if response is not None else {"locked": True})
+                if response is None:
+                    return
+            deadline = time.monotonic() + timeout
+    finally:
+        sock.close()
+        # a new agent may already have replaced the socket
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(path).st_ino == inode:
+                os.unlink(path)
+
+
+def start(handle, timeout):
+    # the socket is bound before forking, so requests sent right away wait in its backlog
+    sock = listen()
+    if os.fork():
+        sock.close()
+        return
+
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    try:
+        serve(sock, handle, timeout)
+    except Exception:
+        sys.exit(1)
+    # exiting normally runs the atexit handlers that lock the storage and clear the clipboard
+    sys.exit(0)
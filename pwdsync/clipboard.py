@@ -5,11 +5,8 @@ import pwdsync.crypto as crypto
 import pwdsync.exceptions as exceptions
 from pwdsync.config import config
 
-try:
-    import pyperclip
-    HAS_PYPERCLIP = True
-except ImportError:
-    HAS_PYPERCLIP = False
+pyperclip = None
+HAS_PYPERCLIP = None
 
 
 cliphash = None
@@ -24,9 +21,21 @@ def clear_clipboard():
         cliphash = None
 
 
+def load_backend():
+    # importing pyperclip probes for clipboard programs, so it happens on first use or in the background
+    global pyperclip, HAS_PYPERCLIP
+    if HAS_PYPERCLIP is None:
+        try:
+            import pyperclip
+            HAS_PYPERCLIP = True
+        except ImportError:
+            HAS_PYPERCLIP = False
+    return HAS_PYPERCLIP
+
+
 def copy(pwd):
     global cliphash, timer
-    if not HAS_PYPERCLIP:
+    if not load_backend():
         raise exceptions.NoClipboardException()
 
     pyperclip.copy(pwd)
@@ -1,33 +1,83 @@
+import json
 import os
+import secrets
 import sys
-import yaml
 
 import pwdsync.utils as utils
 
+yaml = utils.lazy_import("yaml")
 
 CONFIG_FILE_NAME = "config.yml"
+# the parsed config file as JSON, which loads much faster than YAML
+CONFIG_CACHE_NAME = "config.cache.json"
 CONFIG_DEFAULTS = {
     "password_file_path": "$pwdsync/passwords",
     "lock_timeout": 60,
     "clipboard_timeout": 30,
     "password_show_time": 5,
+    "kdf_n": 524288,
+    "kdf_r": 8,
+    "kdf_p": 1,
+    "kdf_target_time": 0.5,
+    "kdf_max_memory": 512,
+    "max_log_size": 1024,
+    "history_retention_days": 365,
+    "history_page_size": 20,
+    "backup_count": 3,
+    "lock_vault": True,
+    "sync_server": "localhost:7123",
+    "device_id": "",
     "test": False,
     "show_tracebacks": False
 }
 
 
 def load_config():
-    config = CONFIG_DEFAULTS
+    config = dict(CONFIG_DEFAULTS)
     path = utils.get_pwdsync_file(CONFIG_FILE_NAME)
     if os.path.isfile(path):
-        with open(path) as f:
-            config.update(yaml.load(f))
+        config.update(read_config_file(path))
     else:
         with open(path, "w") as f:
             yaml.dump(config, f, default_flow_style=False)
     return resolve_path_vars(config)
 
 
+def read_config_file(path):
+    stat = os.stat(path)
+    stat = [stat.st_mtime_ns, stat.st_size]
+    cache_path = utils.get_pwdsync_file(CONFIG_CACHE_NAME)
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached["stat"] == stat:
+            return cached["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    with open(path) as f:
+        values = yaml.safe_load(f) or {}
+    try:
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump({"stat": stat, "config": values}, f)
+        os.replace(cache_path + ".tmp", cache_path)
+    except (OSError, TypeError, ValueError):
+        # not every YAML value has a JSON form, such configs are simply parsed every time
+        pass
+    return values
+
+
+def save_config(values):
+    raw = {}
+    path = utils.get_pwdsync_file(CONFIG_FILE_NAME)
+    if os.path.isfile(path):
+        with open(path) as f:
+            raw = yaml.safe_load(f) or {}
+    raw.update(values)
+    with open(path, "w") as f:
+        yaml.dump(raw, f, default_flow_style=False)
+
+
 def resolve_path_vars(config):
     for key, value in config.items():
         if isinstance(value, str):
@@ -39,7 +89,14 @@ def resolve_path_vars(config):
 
 class Config:
     def __init__(self):
-        self.config = load_config()
+        self.values = None
+
+    @property
+    def config(self):
+        # parsed on first access instead of on import
+        if self.values is None:
+            self.values = load_config()
+        return self.values
 
     def __getattr__(self, name):
         return self.config[name]
@@ -47,5 +104,15 @@ class Config:
     def __getitem__(self, name):
         return self.config[name]
 
+    def update(self, **values):
+        save_config(values)
+        self.config.update(resolve_path_vars(values))
+
 
 config = Config()
+
+
+def get_device_id():
+    if not config.device_id:
+        config.update(device_id=secrets.token_hex(8))
+    return config.device_id
@@ -1,21 +1,59 @@
 import base64
 import hashlib
+import hmac
+import io
 import string
+import struct
+import time
+from collections import namedtuple
 
-import Cryptodome.Random
-from Cryptodome.Random.random import choice as random_choice
-from Cryptodome.Cipher import AES
-from Cryptodome.Protocol.KDF import scrypt
-
-from pwdsync.exceptions import WrongPasswordException
+import pwdsync.utils as utils
+from pwdsync.exceptions import CorruptedVaultException, PwdSyncException, WrongPasswordException
 
 SALT_SIZE = 16
 NONCE_SIZE = 16
 MAC_TAG_SIZE = 16
 KEY_LENGTH = 32
 
+# magic, format version, kdf id, scrypt N, r, p followed by the salt and
+# version 1: the nonce
+# version 2: the segment size and the nonce prefix of the segments
+MAGIC = b"\x89PWS"
+SINGLE_SEGMENT_VERSION = 1
+FORMAT_VERSION = 2
+HEADER_STRUCT = struct.Struct("!4sBBIHH")
+SINGLE_SEGMENT_HEADER_SIZE = HEADER_STRUCT.size + SALT_SIZE + NONCE_SIZE
+Header = namedtuple("Header", "version params salt nonce segment_size data")
+
+SEGMENT_SIZE = 64 * 1024
+SEGMENT_STRUCT = struct.Struct("!I")
+NONCE_PREFIX_SIZE = NONCE_SIZE - SEGMENT_STRUCT.size
+SEGMENT = b"\x00"
+FINAL_SEGMENT = b"\x01"
+
+KDF_SCRYPT = 1
+KdfParams = namedtuple("KdfParams", "n r p")
+LEGACY_KDF_PARAMS = KdfParams(524288, 8, 1)
+
+# every secret field gets a key of its own, derived from the vault key and a random salt
+SECRET_KEY_INFO = b"PwdSync secret field"
+SECRET_NONCE_SIZE = 12
+
 PASSWORD_ALPHABET = string.ascii_letters + string.digits + string.punctuation
 
+# loaded on first use, commands that never touch a key don't pay for them
+AES = utils.lazy_import("Cryptodome.Cipher.AES")
+ChaCha20_Poly1305 = utils.lazy_import("Cryptodome.Cipher.ChaCha20_Poly1305")
+KDF = utils.lazy_import("Cryptodome.Protocol.KDF")
+Random = utils.lazy_import("Cryptodome.Random")
+RandomChoice = utils.lazy_import("Cryptodome.Random.random")
+
+
+def load_backend():
+    # touching the lazy modules imports them, so this can be done ahead of time in the background
+    return AES.MODE_EAX, ChaCha20_Poly1305.new, KDF.scrypt, Random.get_random_bytes
+
+
 def sha256(text):
     if not isinstance(text, bytes):
         text = str(text).encode()
@@ -25,42 +63,351 @@ def sha256(text):
 def gen_pwd(length=20):
     password = ""
     for _ in range(length):
-        password += random_choice(PASSWORD_ALPHABET)
+        password += RandomChoice.choice(PASSWORD_ALPHABET)
     return password
 
 
-def gen_key(pwd, salt):
+def gen_key(pwd, salt, params=LEGACY_KDF_PARAMS):
     if not isinstance(pwd, bytes):
         pwd = str(pwd).encode()
-    return scrypt(pwd, salt, KEY_LENGTH, 524288, 8, 1)
+    return KDF.scrypt(pwd, salt, KEY_LENGTH, params.n, params.r, params.p)
+
+
+def kdf_memory(params):
+    return 128 * params.n * params.r
+
+
+def calibrate(target_time, max_memory=None, r=8, p=1):
+    params = KdfParams(2 ** 14, r, p)
+    salt = bytes(SALT_SIZE)
+    while True:
+        start = time.perf_counter()
+        gen_key(b"calibrate", salt, params)
+        elapsed = time.perf_counter() - start
+
+        stronger = params._replace(n=params.n * 2)
+        if elapsed * 2 > target_time:
+            return params
+        if max_memory is not None and kdf_memory(stronger) > max_memory:
+            return params
+        params = stronger
+
+
+class KeySession:
+    def __init__(self):
+        self.key = None
+        self.salt = None
+        self.params = None
+
+    @property
+    def unlocked(self):
+        return self.key is not None
+
+    def unlock(self, pwd, salt=None, params=LEGACY_KDF_PARAMS):
+        if salt is None:
+            salt = Random.get_random_bytes(SALT_SIZE)
+        key = gen_key(pwd, salt, params)
+        self.lock()
+        self.key = bytearray(key)
+        self.salt = salt
+        self.params = params
 
+    def verify(self, pwd):
+        if not self.unlocked:
+            return False
+        return hmac.compare_digest(gen_key(pwd, self.salt, self.params), bytes(self.key))
 
-def encrypt(text, pwd):
-    salt = Cryptodome.Random.get_random_bytes(SALT_SIZE)
-    key = gen_key(pwd, salt)
-    cipher = AES.new(key, AES.MODE_EAX)
+    def lock(self):
+        if self.key is not None:
+            for i in range(len(self.key)):
+                self.key[i] = 0
+        self.key = None
+        self.salt = None
+        self.params = None
 
-    ciphertext, tag = cipher.encrypt_and_digest(text.encode())
-    return base64.b64encode(salt + cipher.nonce + tag + ciphertext).decode()
+
+def unlock_for(session, pwd, salt, params):
+    if pwd is not None:
+        session.unlock(pwd, salt, params)
+    elif session.salt != salt or session.params != params:
+        raise WrongPasswordException()
+
+
+def pack_header(session, nonce_prefix, segment_size):
+    return (HEADER_STRUCT.pack(MAGIC, FORMAT_VERSION, KDF_SCRYPT, *session.params) + session.salt +
+            SEGMENT_STRUCT.pack(segment_size) + nonce_prefix)
+
+
+def read_header(f):
+    data = f.read(HEADER_STRUCT.size + SALT_SIZE)
+    if len(data) < HEADER_STRUCT.size + SALT_SIZE:
+        raise CorruptedVaultException()
+
+    magic, version, kdf, n, r, p = HEADER_STRUCT.unpack_from(data)
+    if magic != MAGIC:
+        raise PwdSyncException("Not a PwdSync vault")
+    if version not in (SINGLE_SEGMENT_VERSION, FORMAT_VERSION):
+        raise PwdSyncException("Unsupported vault format version: {}".format(version))
+    if kdf != KDF_SCRYPT:
+        raise PwdSyncException("Unsupported key derivation function: {}".format(kdf))
+
+    if version == SINGLE_SEGMENT_VERSION:
+        extra = f.read(NONCE_SIZE)
+        if len(extra) != NONCE_SIZE:
+            raise CorruptedVaultException()
+        segment_size = None
+        nonce = extra
+    else:
+        extra = f.read(SEGMENT_STRUCT.size + NONCE_PREFIX_SIZE)
+        if len(extra) != SEGMENT_STRUCT.size + NONCE_PREFIX_SIZE:
+            raise CorruptedVaultException()
+        segment_size, = SEGMENT_STRUCT.unpack_from(extra)
+        nonce = extra[SEGMENT_STRUCT.size:]
+        if not segment_size:
+            raise CorruptedVaultException()
+
+    salt = data[HEADER_STRUCT.size:]
+    return Header(version, KdfParams(n, r, p), salt, nonce, segment_size, data + extra)
 
 
-def decrypt(text, pwd):
-    text = base64.b64decode(text)
-    salt = text[:SALT_SIZE]
-    text = text[SALT_SIZE:]
+def segment_cipher(session, header, index, final):
+    if index >= 2 ** 32:
+        raise PwdSyncException("Too many segments")
+    nonce = header.nonce + SEGMENT_STRUCT.pack(index)
+    cipher = AES.new(bytes(session.key), AES.MODE_EAX, nonce=nonce)
+    cipher.update(header.data + (FINAL_SEGMENT if final else SEGMENT))
+    return cipher
 
-    nonce = text[:NONCE_SIZE]
-    text = text[NONCE_SIZE:]
 
-    tag = text[:MAC_TAG_SIZE]
-    text = text[MAC_TAG_SIZE:]
+def seal(session, data, associated_data):
+    nonce = Random.get_random_bytes(NONCE_SIZE)
+    cipher = AES.new(bytes(session.key), AES.MODE_EAX, nonce=nonce)
+    cipher.update(associated_data)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return nonce + tag + ciphertext
 
-    key = gen_key(pwd, salt)
-    cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
 
+def unseal(session, data, associated_data):
+    data = memoryview(data)
+    nonce = bytes(data[:NONCE_SIZE])
+    tag = data[NONCE_SIZE:NONCE_SIZE + MAC_TAG_SIZE]
+    cipher = AES.new(bytes(session.key), AES.MODE_EAX, nonce=nonce)
+    cipher.update(associated_data)
     try:
-        decrypted = cipher.decrypt_and_verify(text, tag)
+        return cipher.decrypt_and_verify(data[NONCE_SIZE + MAC_TAG_SIZE:], tag)
     except ValueError:
+        raise CorruptedVaultException()
+
+
+def secret_key(session, salt):
+    return hmac.new(bytes(session.key), SECRET_KEY_INFO + salt, hashlib.sha256).digest()
+
+
+def secret_cipher(session, salt):
+    # each key encrypts a single value, so the salt can double as the nonce. ChaCha20-Poly1305 is set up
+    # several times faster than AES-EAX, which matters when every secret of a vault is sealed again
+    return ChaCha20_Poly1305.new(key=secret_key(session, salt), nonce=salt[:SECRET_NONCE_SIZE])
+
+
+def seal_secret(session, text):
+    salt = Random.get_random_bytes(SALT_SIZE)
+    ciphertext, tag = secret_cipher(session, salt).encrypt_and_digest(text.encode())
+    return base64.b64encode(salt + tag + ciphertext).decode()
+
+
+def unseal_secret(session, data):
+    data = base64.b64decode(data)
+    cipher = secret_cipher(session, data[:SALT_SIZE])
+    try:
+        return cipher.decrypt_and_verify(data[SALT_SIZE + MAC_TAG_SIZE:], data[SALT_SIZE:SALT_SIZE + MAC_TAG_SIZE]).decode()
+    except ValueError:
+        raise CorruptedVaultException()
+
+
+class ArmorWriter:
+    def __init__(self, f):
+        self.f = f
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        size = len(self.buffer) - len(self.buffer) % 3
+        self.f.write(base64.b64encode(self.buffer[:size]))
+        del self.buffer[:size]
+
+    def close(self):
+        self.f.write(base64.b64encode(self.buffer))
+        self.buffer.clear()
+
+
+class VaultWriter:
+    def __init__(self, f, session, armor=False, segment_size=SEGMENT_SIZE):
+        if armor:
+            f = ArmorWriter(f)
+        self.f = f
+        self.armor = armor
+        self.session = session
+        self.segment_size = segment_size
+        self.index = 0
+        self.buffer = bytearray()
+
+        nonce_prefix = Random.get_random_bytes(NONCE_PREFIX_SIZE)
+        data = pack_header(session, nonce_prefix, segment_size)
+        self.header = Header(FORMAT_VERSION, session.params, session.salt, nonce_prefix, segment_size, data)
+        self.f.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        self.buffer += data
+        # a full segment is only written once more data follows, so the final one is never empty
+        # unless the whole plaintext is
+        while len(self.buffer) > self.segment_size:
+            self.__write_segment(memoryview(self.buffer)[:self.segment_size], False)
+            del self.buffer[:self.segment_size]
+
+    def close(self):
+        self.__write_segment(self.buffer, True)
+        self.buffer.clear()
+        if self.armor:
+            self.f.close()
+
+    def __write_segment(self, data, final):
+        cipher = segment_cipher(self.session, self.header, self.index, final)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        self.f.write(ciphertext)
+        self.f.write(tag)
+        self.index += 1
+
+
+def unarmor(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        # armored exports and files written before the binary format
+        f.seek(0)
+        f = io.BytesIO(base64.b64decode(f.read()))
+    f.seek(0)
+    return f
+
+
+def validate_header(f):
+    # everything that can be checked without the password
+    start = f.read(len(MAGIC))
+    f.seek(0)
+    if start == MAGIC:
+        read_header(f)
+        f.seek(0)
+
+
+class VaultReader:
+    def __init__(self, f, session, pwd=None, header=None):
+        if header is not None:
+            # f holds only the segments of a vault whose header was already parsed
+            self.f = f
+            self.session = session
+            self.header = header
+            self.version = header.version
+            self.plaintext = None
+            unlock_for(session, pwd, header.salt, header.params)
+            return
+
+        f = unarmor(f)
+        self.f = f
+        self.session = session
+        start = f.read(len(MAGIC) + 1)
+        f.seek(0)
+        if start[:len(MAGIC)] != MAGIC or start[len(MAGIC)] == SINGLE_SEGMENT_VERSION:
+            self.version = SINGLE_SEGMENT_VERSION
+            self.plaintext = decrypt(f.read(), session, pwd)
+            return
+
+        self.header = read_header(f)
+        self.version = self.header.version
+        self.plaintext = None
+        unlock_for(session, pwd, self.header.salt, self.header.params)
+
+    def __iter__(self):
+        if self.plaintext is not None:
+            yield self.plaintext
+            return
+
+        size = self.header.segment_size + MAC_TAG_SIZE
+        current, following = bytearray(size), bytearray(size)
+        output = bytearray(self.header.segment_size)
+        length = self.f.readinto(current)
+        index = 0
+        while True:
+            next_length = self.f.readinto(following)
+            final = next_length == 0
+            if length < MAC_TAG_SIZE or (not final and length != size):
+                raise CorruptedVaultException()
+
+            data = memoryview(current)[:length - MAC_TAG_SIZE]
+            tag = memoryview(current)[length - MAC_TAG_SIZE:length]
+            cipher = segment_cipher(self.session, self.header, index, final)
+            try:
+                cipher.decrypt_and_verify(data, tag, output=memoryview(output)[:len(data)])
+            except ValueError:
+                if index == 0 and not (final and self.__verifies(data, tag)):
+                    self.session.lock()
+                    raise WrongPasswordException()
+                raise CorruptedVaultException()
+            yield memoryview(output)[:len(data)]
+
+            if final:
+                return
+            current, following = following, current
+            length = next_length
+            index += 1
+
+    def __verifies(self, data, tag):
+        # a first segment that is valid as a non-final one means the file was truncated
+        try:
+            segment_cipher(self.session, self.header, 0, False).decrypt_and_verify(data, tag)
+            return True
+        except ValueError:
+            return False
+
+
+def decrypt(data, session, pwd=None):
+    data = memoryview(data)
+    if data[:len(MAGIC)] == MAGIC:
+        params, salt, nonce = unpack_single_segment_header(data)
+        header = data[:SINGLE_SEGMENT_HEADER_SIZE]
+        data = data[SINGLE_SEGMENT_HEADER_SIZE:]
+    else:
+        # files written before the header was introduced
+        params = LEGACY_KDF_PARAMS
+        header = b""
+        salt = data[:SALT_SIZE]
+        nonce = data[SALT_SIZE:SALT_SIZE + NONCE_SIZE]
+        data = data[SALT_SIZE + NONCE_SIZE:]
+
+    salt = bytes(salt)
+    nonce = bytes(nonce)
+    tag = data[:MAC_TAG_SIZE]
+    data = data[MAC_TAG_SIZE:]
+
+    unlock_for(session, pwd, salt, params)
+    cipher = AES.new(bytes(session.key), AES.MODE_EAX, nonce=nonce)
+    cipher.update(header)
+
+    decrypted = bytearray(len(data))
+    try:
+        cipher.decrypt_and_verify(data, tag, output=decrypted)
+    except ValueError:
+        session.lock()
         raise WrongPasswordException()
 
-    return decrypted.decode()
+    return decrypted
+
+
+def unpack_single_segment_header(data):
+    header = read_header(io.BytesIO(data[:SINGLE_SEGMENT_HEADER_SIZE]))
+    if header.version != SINGLE_SEGMENT_VERSION:
+        raise CorruptedVaultException()
+    return header.params, header.salt, header.nonce
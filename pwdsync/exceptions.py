@@ -9,6 +9,11 @@ class WrongPasswordException(PwdSyncException):
     pass
 
 
+class CorruptedVaultException(PwdSyncException):
+    def __init__(self):
+        super().__init__("The password file is corrupted or truncated")
+
+
 class NoClipboardException(PwdSyncException):
     pass
 
@@ -0,0 +1,94 @@
+import csv
+import json
+import os
+
+import pwdsync.crypto as crypto
+
+FIELDS = ("category", "name", "username", "password", "password2", "comment")
+
+
+def iter_rows(storage, categories=()):
+    # walks the path index, so only the row that is being written is revealed and kept
+    for path, pwd in storage.iter_category(*categories):
+        yield {
+            "category": "/".join(path[:-1]),
+            "name": pwd.name,
+            "username": pwd.username,
+            "password": storage.reveal(pwd),
+            "password2": storage.reveal(pwd, "password2"),
+            "comment": pwd.comment
+        }
+
+
+def write_csv(f, rows):
+    writer = csv.writer(f)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow(["" if row[field] is None else row[field] for field in FIELDS])
+
+
+def write_json(f, rows):
+    f.write('{"passwords": [')
+    separator = "\n"
+    for row in rows:
+        f.write(separator + json.dumps(row, ensure_ascii=False))
+        separator = ",\n"
+    f.write("\n]}\n")
+
+
+def write_jsonl(f, rows):
+    for row in rows:
+        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+FORMATS = {
+    "csv": write_csv,
+    "json": write_json,
+    "jsonl": write_jsonl
+}
+
+
+class Counted:
+    # counts the rows while they are written
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+class EncryptedText:
+    # a text file that encrypts everything written to it in the format of the password file
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, text):
+        self.writer.write(text.encode())
+
+
+def open_private(path, mode, **kwargs):
+    # only the owner can read the file, also if it already existed with other permissions
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, 0o600)
+        return os.fdopen(fd, mode, **kwargs)
+    except BaseException:
+        os.close(fd)
+        raise
+
+
+def export_file(storage, path, categories=(), format="csv", session=None, armor=False):
+    # session holds the key of the export passphrase, without one the file is plaintext
+    rows = Counted(iter_rows(storage, categories))
+    if session is None:
+        with open_private(path, "w", newline="", encoding="utf-8") as f:
+            FORMATS[format](f, rows)
+        return rows.count
+
+    with open_private(path, "wb") as f, crypto.VaultWriter(f, session, armor) as writer:
+        FORMATS[format](EncryptedText(writer), rows)
+    return rows.count
@@ -0,0 +1,42 @@
+import json
+
+import pwdsync.utils as utils
+
+# only imported once something is encoded or decoded
+try:
+    orjson = utils.lazy_import("orjson")
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+try:
+    ujson = utils.lazy_import("ujson")
+    HAS_UJSON = True
+except ImportError:
+    HAS_UJSON = False
+
+
+if HAS_ORJSON:
+    BACKEND = "orjson"
+elif HAS_UJSON:
+    BACKEND = "ujson"
+else:
+    BACKEND = "json"
+
+
+def loads(data):
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    if HAS_UJSON:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj, default=None):
+    if HAS_ORJSON:
+        return orjson.dumps(obj, default=default)
+    if HAS_UJSON:
+        return ujson.dumps(obj, ensure_ascii=False, default=default).encode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode()
@@ -1,60 +1,238 @@
 import functools
+import hashlib
+import itertools
+import json
+import operator
+import sys
+import time as _time
+from collections import namedtuple
 
-from pwdsync.storage import Password, Storage
+import pwdsync.utils as utils
+from pwdsync.config import get_device_id
+from pwdsync.password import Password, value_from_json, value_to_json
+
+ID_SIZE = 16
+# marks events from before ids were stored
+LEGACY_ID = ""
+event_counter = itertools.count()
+# events are ordered by their lamport clock, so an event always comes after everything its device had seen when it was
+# made, no matter how far the clocks of the devices are apart. events from before clocks have clock 0
+sort_key = operator.attrgetter("clock", "time", "device", "id")
+order_key = operator.attrgetter("clock", "time")
+
+
+MergeResult = namedtuple("MergeResult", "history new_local new_remote diverged conflicts")
+# two devices changed the same field without seeing the change of the other one, the later one in the order wins
+Conflict = namedtuple("Conflict", "path key winner loser")
+
+
+def merge_histories(local, remote):
+    local, local_keys, local_sorted = with_sort_keys(local)
+    remote, remote_keys, _ = with_sort_keys(remote)
+    # synced histories usually share a long prefix which is copied without comparing event by event
+    i = j = common_prefix(local_keys, remote_keys)
+    history = local[:i]
+    new_local = new_remote = 0
+    # index of the first event that is new to the local history
+    diverged = None
+
+    # one side only has events after all events of the other one
+    if i < len(local) and j < len(remote):
+        if local_keys[-1][:2] < remote_keys[j][:2]:
+            history.extend(local[i:])
+            new_local += len(local) - i
+            i = len(local)
+        elif remote_keys[-1][:2] < local_keys[i][:2]:
+            diverged = len(history)
+            history.extend(remote[j:])
+            new_remote += len(remote) - j
+            j = len(remote)
+
+    # legacy events of the same second may be in different places on the two sides
+    local_tail = {event.id for event in local[i:]}
+    while i < len(local) and j < len(remote):
+        if local_keys[i] == remote_keys[j]:
+            history.append(local[i])
+            i += 1
+            j += 1
+        elif remote[j].id in local_tail:
+            j += 1
+        elif local_keys[i] < remote_keys[j]:
+            history.append(local[i])
+            i += 1
+            new_local += 1
+        else:
+            if diverged is None:
+                diverged = len(history)
+            history.append(remote[j])
+            j += 1
+            new_remote += 1
+
+    remaining = [event for event in remote[j:] if event.id not in local_tail]
+    if remaining and diverged is None:
+        diverged = len(history)
+    history.extend(local[i:])
+    history.extend(remaining)
+    new_local += len(local) - i
+    new_remote += len(remaining)
+    if not local_sorted:
+        # positions in the local history no longer match, so nothing before any event can be trusted
+        diverged = 0
+    return MergeResult(history, new_local, new_remote, len(history) if diverged is None else diverged, [])
+
+
+def common_prefix(first, second):
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[low:middle] == second[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def with_sort_keys(events):
+    # legacy events of the same second stay in the order they happened in, the rest only decides between the two sides
+    orders = list(map(order_key, events))
+    if all(map(operator.le, orders, itertools.islice(orders, 1, None))):
+        return events, list(map(sort_key, events)), True
+    events = sorted(events, key=order_key)
+    return events, list(map(sort_key, events)), False
+
+
+def find_conflicts(local, remote):
+    # local and remote are the events each side had not seen, entries added on both sides conflict as a whole
+    changed = {event_field(event): event for event in local}
+    conflicts = []
+    for event in remote:
+        field = event_field(event)
+        if field in changed:
+            winner, loser = sorted((changed[field], event), key=sort_key, reverse=True)
+            conflicts.append(Conflict(field[:2], field[2], winner, loser))
+    return conflicts
+
+
+def event_field(event):
+    return event.categories, event.name, getattr(event, "key", None)
 
 
 @functools.total_ordering
 class HistoryEvent:
-    def __init__(self, event, categories, name, time=None):
-        self.event = event
-        self.time = int(time.time()) if time is None else time
-        self.categories = categories if isinstance(categories, str) else "/".join(categories)
-        self.name = name
+    __slots__ = ("event", "time", "categories", "name", "id", "clock", "device")
+
+    def __init__(self, event, categories, name, time=None, clock=0, device=""):
+        # the same few strings repeat in most events, so they are shared instead of loaded once per event
+        self.event = sys.intern(event)
+        self.time = int(_time.time()) if time is None else time
+        self.categories = sys.intern(categories if isinstance(categories, str) else "/".join(categories))
+        self.name = sys.intern(name)
+        self.clock = clock
+        self.device = sys.intern(device)
+        self.id = None
+
+    def init_id(self, id):
+        if id is None:
+            id = self.content_id(get_device_id(), next(event_counter))
+        elif id == LEGACY_ID:
+            # the same old event gets the same id on every device
+            id = self.content_id("", 0)
+        self.id = id
+
+    def content_id(self, device, counter):
+        fields = [self.event, self.time, self.categories, self.name] + self.content() + [device, counter]
+        canonical = json.dumps(fields, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode()).digest()[:ID_SIZE].hex()
+
+    def content(self):
+        return []
 
     def __lt__(self, other):
         if isinstance(other, HistoryEvent):
-            return (self.time, hash(self)) < (other.time, hash(other))
+            return sort_key(self) < sort_key(other)
         return self.time < other
 
     def __hash__(self):
-        return hash(repr(self))
+        return hash(self.id)
 
     def __eq__(self, other):
         if isinstance(other, HistoryEvent):
-            return (self.time, hash(self)) == (other.time, hash(other))
+            return self.id == other.id
         return NotImplemented
 
     def __repr__(self):
         return "<{} at {}: {}/{}>".format(self.event, self.time, self.categories, self.name)
 
+    def to_json(self):
+        return {
+            "event": self.event,
+            "time": self.time,
+            "categories": self.categories,
+            "name": self.name,
+            "id": self.id,
+            "clock": self.clock,
+            "device": self.device
+        }
+
     @staticmethod
     def from_json(dct):
+        id = dct.get("id", LEGACY_ID)
+        clock = dct.get("clock", 0)
+        device = dct.get("device", "")
         if dct["event"] == "ADD":
-            return AddEvent(dct["categories"], dct["name"], Password.from_json(dct["pwd"]), dct["time"])
+            pwd = dct["pwd"]
+            if not isinstance(pwd, Password):
+                pwd = Password.from_json(pwd)
+            return AddEvent(dct["categories"], dct["name"], pwd, dct["time"], id, clock, device)
         elif dct["event"] == "EDIT":
-            return EditEvent(dct["categories"], dct["name"], dct["key"], dct["value"], dct["time"])
+            return EditEvent(dct["categories"], dct["name"], dct["key"], value_from_json(dct["value"]), dct["time"], id,
+                             clock, device)
         raise ValueError("Invalid json obj for HistoryEvent: " + repr(dct))
 
 
 class AddEvent(HistoryEvent):
-    def __init__(self, categories, name, pwd, time=None):
-        super().__init__("ADD", time, categories, name)
+    __slots__ = ("pwd",)
+
+    def __init__(self, categories, name, pwd, time=None, id=None, clock=0, device=""):
+        super().__init__("ADD", categories, name, time, clock, device)
         self.pwd = pwd
+        self.init_id(id)
+
+    def content(self):
+        return [self.pwd.name, self.pwd.username, value_to_json(self.pwd.password), value_to_json(self.pwd.password2),
+                self.pwd.comment]
+
+    def to_json(self):
+        dct = super().to_json()
+        dct["pwd"] = self.pwd.to_json()
+        return dct
 
-    def apply(self, storage: Storage):
-        category = storage.get_category(*self.categories.split("/"), create=True)
-        category[self.name] = self.pwd
+    def apply(self, storage: "Storage"):
+        storage.set_pwd(utils.split_path(self.categories) + [self.name], self.pwd)
 
 
 class EditEvent(HistoryEvent):
-    def __init__(self, categories, name, key, value, time=None):
-        super().__init__("EDIT", time, categories, name)
-        self.key = key
+    __slots__ = ("key", "value")
+
+    def __init__(self, categories, name, key, value, time=None, id=None, clock=0, device=""):
+        super().__init__("EDIT", categories, name, time, clock, device)
+        self.key = sys.intern(key)
         self.value = value
+        self.init_id(id)
+
+    def content(self):
+        return [self.key, value_to_json(self.value)]
+
+    def to_json(self):
+        dct = super().to_json()
+        dct["key"] = self.key
+        dct["value"] = value_to_json(self.value)
+        return dct
 
-    def apply(self, storage: Storage):
-        pwd = storage.get_pwd(*self.categories.split("/"), self.name)
-        setattr(pwd, self.key, self.value)
+    def apply(self, storage: "Storage"):
+        # passwords are replaced instead of changed in place, so checkpoints and add events can share them
+        path = utils.split_path(self.categories) + [self.name]
+        storage.set_pwd(path, storage.get_pwd(*path).replace(**{self.key: self.value}))
 
     def __repr__(self):
         return "<{} at {}: {}/{} - {}: {}>".format(self.event, self.time, self.categories, self.name, self.key, self.value)
@@ -0,0 +1,130 @@
+import bisect
+import heapq
+import itertools
+import re
+import time as _time
+
+import pwdsync.utils as utils
+
+datetime = utils.lazy_import("datetime")
+
+RELATIVE_TIME_PATTERN = re.compile(r"(\d+)([mhdw])")
+SECONDS_PER_UNIT = {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+
+def event_path(event):
+    return event.categories + "/" + event.name if event.categories else event.name
+
+
+def parse_time(text, end=False):
+    # an age like 7d, a unix time, a date or a local date and time like 2020-01-31T12:00. end makes a date include
+    # its whole day
+    match = RELATIVE_TIME_PATTERN.fullmatch(text)
+    if match:
+        return int(_time.time()) - int(match.group(1)) * SECONDS_PER_UNIT[match.group(2)]
+    if text.isdigit():
+        return int(text)
+    moment = datetime.datetime.fromisoformat(text)
+    if end and len(text) == len("2020-01-31"):
+        moment += datetime.timedelta(days=1)
+    return int(moment.timestamp())
+
+
+class HistoryIndex:
+    # positions of the history events by path, field key and time. The history is only ever appended to in place,
+    # so update adds the new events and a replaced history gets a new index
+    def __init__(self, history):
+        self.history = history
+        self.count = 0
+        # "categories/name" -> positions of the events of that entry
+        self.paths = {}
+        # the keys of paths in order, so a category is a range of them. None after new paths were added
+        self.sorted_paths = None
+        # the key of edit events -> their positions
+        self.keys = {}
+        # the times in order and the positions of their events, None while the history itself is in time order
+        self.times = []
+        self.positions = None
+        self.update()
+
+    def is_current(self, history):
+        return history is self.history and len(history) >= self.count
+
+    def update(self):
+        start = self.count
+        if start == len(self.history):
+            return
+        for position in range(start, len(self.history)):
+            event = self.history[position]
+            path = event_path(event)
+            positions = self.paths.get(path)
+            if positions is None:
+                positions = self.paths[path] = []
+                self.sorted_paths = None
+            positions.append(position)
+            key = getattr(event, "key", None)
+            if key is not None:
+                self.keys.setdefault(key, []).append(position)
+        self.count = len(self.history)
+        self.update_times(start)
+
+    def update_times(self, start):
+        times = [event.time for event in self.history[start:]]
+        checked = self.times[-1:] + times
+        if all(first <= second for first, second in zip(checked, itertools.islice(checked, 1, None))):
+            self.times.extend(times)
+            if self.positions is not None:
+                self.positions.extend(range(start, self.count))
+            return
+        # the clocks of the devices disagree, so the history isn't in time order. Sorting is stable and mostly sorted
+        # input is fast
+        if self.positions is None:
+            self.positions = list(range(start))
+        self.positions.extend(range(start, self.count))
+        self.positions.sort(key=lambda position: self.history[position].time)
+        self.times = [self.history[position].time for position in self.positions]
+
+    def path_positions(self, path):
+        # the position lists of the entry at path or of all entries in the category at path
+        if self.sorted_paths is None:
+            self.sorted_paths = sorted(self.paths)
+        # "/" is followed by "0", so the entries below path lie between the two
+        low = bisect.bisect_left(self.sorted_paths, path + "/")
+        high = bisect.bisect_left(self.sorted_paths, path + "0")
+        lists = [self.paths[key] for key in self.sorted_paths[low:high]]
+        if path in self.paths:
+            lists.append(self.paths[path])
+        return lists
+
+    def time_range(self, low, high):
+        if self.positions is None:
+            return reversed(range(low, high))
+        return iter(sorted(self.positions[low:high], reverse=True))
+
+    def query(self, path="", since=None, until=None, key=None):
+        # the matching events newest first, lazily. Only the smallest of the candidate sets of the conditions is
+        # walked and the other conditions are checked on its events. until is exclusive
+        candidates = [(self.count, lambda: reversed(range(self.count)))]
+        if path:
+            lists = self.path_positions(path)
+            candidates.append((sum(map(len, lists)), lambda: heapq.merge(*map(reversed, lists), reverse=True)))
+        if key is not None:
+            keys = self.keys.get(key, [])
+            candidates.append((len(keys), lambda: reversed(keys)))
+        if since is not None or until is not None:
+            low = 0 if since is None else bisect.bisect_left(self.times, since)
+            high = len(self.times) if until is None else bisect.bisect_left(self.times, until)
+            high = max(low, high)
+            candidates.append((high - low, lambda: self.time_range(low, high)))
+        _, positions = min(candidates, key=lambda candidate: candidate[0])
+
+        prefix = path + "/"
+        for position in positions():
+            event = self.history[position]
+            if path and event_path(event) != path and not event_path(event).startswith(prefix):
+                continue
+            if key is not None and getattr(event, "key", None) != key:
+                continue
+            if (since is not None and event.time < since) or (until is not None and event.time >= until):
+                continue
+            yield event
@@ -0,0 +1,76 @@
+import os
+import struct
+
+import pwdsync.crypto as crypto
+import pwdsync.utils as utils
+
+LOG_SUFFIX = ".log"
+
+# magic, format version and the nonce prefix of the snapshot the log belongs to
+LOG_MAGIC = b"\x89PWL"
+LOG_VERSION = 1
+LOG_HEADER_SIZE = len(LOG_MAGIC) + 1 + crypto.NONCE_PREFIX_SIZE
+RECORD_STRUCT = struct.Struct("!I")
+
+
+class HistoryLog:
+    def __init__(self, snapshot_path, session, snapshot_id):
+        self.path = snapshot_path + LOG_SUFFIX
+        self.session = session
+        self.header = LOG_MAGIC + bytes([LOG_VERSION]) + snapshot_id
+        # only the first size bytes are valid, anything after them is a torn write
+        self.size = 0
+        self.count = 0
+
+    def read(self):
+        self.size = 0
+        self.count = 0
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            # logs of older snapshots are left over if saving crashed before the log was reset
+            if f.read(LOG_HEADER_SIZE) != self.header:
+                return
+            self.size = LOG_HEADER_SIZE
+
+            while True:
+                length = f.read(RECORD_STRUCT.size)
+                if len(length) < RECORD_STRUCT.size:
+                    break
+                length, = RECORD_STRUCT.unpack(length)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+
+                yield crypto.unseal(self.session, data, self.associated_data(self.count))
+                self.size += RECORD_STRUCT.size + length
+                self.count += 1
+
+    def append(self, data):
+        # returns the seconds the fsync took
+        record = crypto.seal(self.session, data, self.associated_data(self.count))
+        if self.size:
+            f = open(self.path, "r+b")
+            f.seek(self.size)
+        else:
+            f = open(self.path, "wb")
+            f.write(self.header)
+            self.size = LOG_HEADER_SIZE
+
+        with f:
+            f.truncate()
+            f.write(RECORD_STRUCT.pack(len(record)) + record)
+            synced = utils.fsync(f)
+        self.size += RECORD_STRUCT.size + len(record)
+        self.count += 1
+        return synced
+
+    def reset(self):
+        self.size = 0
+        self.count = 0
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def associated_data(self, index):
+        return self.header + RECORD_STRUCT.pack(index)
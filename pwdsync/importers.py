@@ -0,0 +1,323 @@
+import base64
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+
+import pwdsync.crypto as crypto
+import pwdsync.exceptions as exceptions
+from pwdsync.password import Password
+
+# entries are added and indexed in batches of this size, so only one batch is held besides the storage itself
+BATCH_SIZE = 500
+CHUNK_SIZE = 64 * 1024
+# the base64 of the first three bytes of the magic
+ARMORED_MAGIC = base64.b64encode(crypto.MAGIC[:3])
+
+# lower case column names used by the CSV exports of KeePass, Bitwarden, browsers and most other managers
+CSV_COLUMNS = {
+    "name": ("name", "title", "account"),
+    "username": ("username", "login_username", "user name", "login name", "login", "user"),
+    "password": ("password", "login_password"),
+    "password2": ("password2",),
+    "url": ("url", "login_uri", "web site", "website"),
+    "notes": ("notes", "comment", "comments", "extra"),
+    "category": ("folder", "group", "category", "grouping")
+}
+
+ImportResult = namedtuple("ImportResult", "added skipped renamed")
+
+
+def entry(categories, name, username, password, url=None, notes=None, password2=None):
+    # the name can't contain the path separator and there is no field for the url, so it goes into the comment
+    name = (name or url or "unnamed").replace("/", "-").strip()
+    categories = [category.strip() for category in categories if category and category.strip()]
+    comment = "\n".join(part for part in (url, notes) if part) or None
+    return categories, Password(name, username or None, password or None, password2 or None, comment)
+
+
+def iter_csv(f):
+    reader = csv.reader(f)
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [column.strip().lower() for column in header]
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        columns[field] = next((header.index(name) for name in names if name in header), None)
+    if columns["name"] is None and columns["url"] is None:
+        raise exceptions.PwdSyncException("Unknown CSV format: no name or url column")
+
+    for row in reader:
+        if not any(row):
+            continue
+        values = {field: row[index] if index is not None and index < len(row) else None
+                  for field, index in columns.items()}
+        yield entry((values["category"] or "").split("/"), values["name"], values["username"], values["password"],
+                    values["url"], values["notes"], values["password2"])
+
+
+def iter_keepass_xml(f):
+    # elements are removed from the tree once they were read, otherwise iterparse would keep the whole file
+    groups = []
+    elements = []
+    for event, element in ElementTree.iterparse(f, ("start", "end")):
+        if event == "start":
+            elements.append(element)
+            if element.tag == "Group":
+                groups.append(None)
+            continue
+
+        elements.pop()
+        parent = elements[-1] if elements else None
+        if element.tag == "Name" and parent is not None and parent.tag == "Group":
+            groups[-1] = element.text
+        elif element.tag == "Entry" and parent is not None and parent.tag == "Group":
+            strings = {}
+            # direct children only, older versions of the entry are kept under History
+            for string in element.findall("String"):
+                value = string.find("Value")
+                if value is not None and value.get("Protected") == "True":
+                    raise exceptions.PwdSyncException("Encrypted KeePass files are not supported, export as XML")
+                strings[string.findtext("Key")] = value.text if value is not None else None
+            # the first group is the database itself
+            yield entry(groups[1:], strings.get("Title"), strings.get("UserName"), strings.get("Password"),
+                        strings.get("URL"), strings.get("Notes"))
+            parent.remove(element)
+        elif element.tag == "Group":
+            groups.pop()
+            if parent is not None:
+                parent.remove(element)
+        elif element.tag == "Meta":
+            # icons and attachments
+            element.clear()
+
+
+class JsonStream:
+    # reads one value after another from a large JSON document without loading all of it
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # reads at least as much as is buffered, so a large value isn't decoded again for every chunk
+        chunk = self.f.read(max(CHUNK_SIZE, len(self.buffer)))
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            return False
+        self.pos += 1
+        return True
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        if not self.expect("{"):
+            raise ValueError("Expected a JSON object")
+        while not self.expect("}"):
+            key = self.value()
+            if not self.expect(":"):
+                raise ValueError("Expected ':' after " + repr(key))
+            yield key
+            self.expect(",")
+
+    def elements(self):
+        if not self.expect("["):
+            raise ValueError("Expected a JSON array")
+        while not self.expect("]"):
+            yield self.value()
+            self.expect(",")
+
+
+def iter_json(f):
+    # Bitwarden writes the folders before the items, which are streamed like the passwords of PwdSync's own export
+    stream = JsonStream(f)
+    folders = {}
+    for key in stream.items():
+        if key == "passwords":
+            for row in stream.elements():
+                yield row_entry(row)
+        elif key == "items":
+            for item in stream.elements():
+                login = item.get("login") or {}
+                uris = login.get("uris") or [{}]
+                folder = folders.get(item.get("folderId"), "")
+                yield entry(folder.split("/"), item.get("name"), login.get("username"), login.get("password"),
+                            uris[0].get("uri"), item.get("notes"))
+        else:
+            value = stream.value()
+            if key == "encrypted" and value:
+                raise exceptions.PwdSyncException("Encrypted Bitwarden exports are not supported")
+            if key == "folders":
+                folders = {folder["id"]: folder["name"] for folder in value}
+
+
+def iter_jsonl(f):
+    for line in f:
+        if line.strip():
+            yield row_entry(json.loads(line))
+
+
+def row_entry(row):
+    # a row of PwdSync's own export
+    return entry((row.get("category") or "").split("/"), row.get("name"), row.get("username"), row.get("password"),
+                 notes=row.get("comment"), password2=row.get("password2"))
+
+
+FORMATS = {
+    "csv": iter_csv,
+    "keepass": iter_keepass_xml,
+    "bitwarden": iter_json,
+    "json": iter_json,
+    "jsonl": iter_jsonl
+}
+EXTENSIONS = {
+    ".csv": "csv",
+    ".xml": "keepass",
+    ".json": "json",
+    ".jsonl": "jsonl"
+}
+
+
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXTENSIONS:
+        raise exceptions.PwdSyncException("Unknown file type {}, use --format with one of {}".format(
+            repr(extension), ", ".join(FORMATS)))
+    return EXTENSIONS[extension]
+
+
+def is_encrypted(path):
+    # exports encrypted with a passphrase use the format of the password file
+    with open(path, "rb") as f:
+        start = f.read(len(crypto.MAGIC))
+    return start == crypto.MAGIC or start == ARMORED_MAGIC
+
+
+class DecryptedFile(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.rest = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.rest:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            # the reader reuses its buffer for the next chunk
+            self.rest = bytes(chunk)
+        size = min(len(buffer), len(self.rest))
+        buffer[:size] = self.rest[:size]
+        self.rest = self.rest[size:]
+        return size
+
+
+@contextlib.contextmanager
+def open_export(path, format, passphrase=None):
+    with open(path, "rb") as f:
+        if passphrase is not None:
+            reader = crypto.VaultReader(f, crypto.KeySession(), crypto.sha256(passphrase))
+            f = io.BufferedReader(DecryptedFile(reader), CHUNK_SIZE)
+        if format == "keepass":
+            yield f
+        else:
+            # utf-8-sig drops the byte order mark some managers write
+            yield io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+
+
+def read_entries(path, format=None, passphrase=None):
+    if format is None:
+        # an encrypted export keeps the extension of its format, e.g. passwords.csv
+        format = detect_format(path)
+    if format not in FORMATS:
+        raise exceptions.PwdSyncException("Unknown format {}, use one of {}".format(repr(format), ", ".join(FORMATS)))
+    with open_export(path, format, passphrase) as f:
+        yield from FORMATS[format](f)
+
+
+def batches(entries, size=BATCH_SIZE):
+    entries = iter(entries)
+    while True:
+        batch = list(itertools.islice(entries, size))
+        if not batch:
+            return
+        yield batch
+
+
+def import_file(storage, path, format=None, passphrase=None, batch_size=BATCH_SIZE):
+    added = skipped = renamed = 0
+    for batch in batches(read_entries(path, format, passphrase), batch_size):
+        pending = {}
+        pending_categories = set()
+        for categories, pwd in batch:
+            path = tuple(categories) + (pwd.name,)
+            existing = storage.get_pwd(*path) or pending.get(path)
+            if existing is not None and is_same(storage, existing, pwd):
+                # imported before
+                skipped += 1
+                continue
+            free = free_path(storage, pending, pending_categories, path)
+            if free != path:
+                renamed += 1
+                path = free
+                pwd = pwd.replace(name=path[-1])
+            pending[path] = pwd
+            pending_categories.update(path[:i] for i in range(1, len(path)))
+        storage.add_pwds((path[:-1], pwd) for path, pwd in pending.items())
+        added += len(pending)
+    return ImportResult(added, skipped, renamed)
+
+
+def is_same(storage, existing, pwd):
+    return existing.username == pwd.username and storage.reveal(existing) == storage.reveal(pwd)
+
+
+def free_path(storage, pending, pending_categories, path):
+    # entries and categories can't share a name, so clashes get a number like "name (2)"
+    path = list(path)
+    for i in range(len(path)):
+        name = path[i]
+        number = 2
+        while is_taken(storage, pending, pending_categories, tuple(path[:i + 1]), i == len(path) - 1):
+            path[i] = "{} ({})".format(name, number)
+            number += 1
+    return tuple(path)
+
+
+def is_taken(storage, pending, pending_categories, path, is_entry):
+    if storage.get_pwd(*path) is not None or path in pending:
+        return True
+    return is_entry and (storage.get_path_index().is_category(path) or path in pending_categories)
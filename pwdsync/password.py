@@ -0,0 +1,70 @@
+SECRET_FIELDS = ("password", "password2")
+
+
+class Sealed:
+    # a secret field encrypted under its own key derived from the vault key, see crypto.seal_secret
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, Sealed) and self.data == other.data
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __repr__(self):
+        return "[sealed]"
+
+    def to_json(self):
+        return {"sealed": self.data}
+
+
+def value_to_json(value):
+    return value.to_json() if isinstance(value, Sealed) else value
+
+
+def value_from_json(value):
+    return Sealed(value["sealed"]) if isinstance(value, dict) else value
+
+
+class Password:
+    __slots__ = ("name", "username", "password", "password2", "comment")
+
+    def __init__(self, name, username, password, password2=None, comment=None):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.password2 = password2
+        self.comment = comment
+
+    def replace(self, **changes):
+        pwd = Password(self.name, self.username, self.password, self.password2, self.comment)
+        for key, value in changes.items():
+            setattr(pwd, key, value)
+        return pwd
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "username": self.username,
+            "password": value_to_json(self.password),
+            "password2": value_to_json(self.password2),
+            "comment": self.comment
+        }
+
+    @staticmethod
+    def from_json(json_obj):
+        try:
+            return Password(
+                json_obj["name"],
+                json_obj["username"],
+                value_from_json(json_obj["password"]),
+                value_from_json(json_obj.get("password2", None)),
+                json_obj.get("comment", None))
+        except KeyError as e:
+            raise ValueError("{} not specified".format(e.args[0]))
+
+    def __str__(self):
+        return "{}\t\t{}".format(self.name, self.username)
@@ -0,0 +1,48 @@
+import bisect
+
+
+class PathIndex:
+    def __init__(self, passwords=None):
+        # path tuple -> Password and category path tuple -> sorted names of its entries
+        self.passwords = {}
+        self.children = {(): []}
+        if passwords:
+            self.__build(passwords, ())
+
+    def __build(self, category, path):
+        names = sorted(category)
+        self.children[path] = names
+        for name in names:
+            value = category[name]
+            if isinstance(value, dict):
+                self.__build(value, path + (name,))
+            else:
+                self.passwords[path + (name,)] = value
+
+    def get(self, path):
+        return self.passwords.get(path)
+
+    def is_category(self, path):
+        return path in self.children
+
+    def update(self, path, old, new):
+        self.passwords[path] = new
+        if old is not None:
+            return
+
+        for i in range(len(path) - 1):
+            if path[:i + 1] not in self.children:
+                bisect.insort(self.children[path[:i]], path[i])
+                self.children[path[:i + 1]] = []
+        bisect.insort(self.children[path[:-1]], path[-1])
+
+    def entries(self, path=()):
+        for name in self.children[path]:
+            yield name, self.passwords.get(path + (name,))
+
+    def walk(self, path=()):
+        for name, pwd in self.entries(path):
+            if pwd is None:
+                yield from self.walk(path + (name,))
+            else:
+                yield path + (name,), pwd
@@ -0,0 +1,135 @@
+import bisect
+import heapq
+import re
+
+NGRAM_SIZE = 3
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# secret fields are never indexed
+FIELD_WEIGHTS = {
+    "name": 8,
+    "username": 4,
+    "categories": 2,
+    "comment": 1
+}
+# in the order of the texts of a document
+WEIGHTS = tuple(FIELD_WEIGHTS.values())
+EXACT_NAME_BONUS = 8
+NAME_PREFIX_BONUS = 4
+
+
+def ngrams(text):
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+
+def token_prefixes(text):
+    return {token[:length] for token in TOKEN_PATTERN.findall(text) for length in range(1, NGRAM_SIZE)}
+
+
+def score_texts(texts, query):
+    # ngrams only narrow down the candidates, the query still has to occur as a whole
+    score = 0
+    for text, weight in zip(texts, WEIGHTS):
+        if query in text:
+            score += weight
+    # the other fields weigh less than the name together, so this only checks names that contain the query
+    if score >= WEIGHTS[0] and texts[0].startswith(query):
+        score += EXACT_NAME_BONUS if texts[0] == query else NAME_PREFIX_BONUS
+    return score
+
+
+def document_fields(path, pwd):
+    return {
+        "name": pwd.name.lower(),
+        "username": (pwd.username or "").lower(),
+        "categories": "/".join(path[:-1]).lower(),
+        "comment": (pwd.comment or "").lower()
+    }
+
+
+class SearchIndex:
+    def __init__(self, passwords=()):
+        self.documents = {}
+        self.ngrams = {}
+        # queries shorter than an ngram match the words of a field that start with them. Their score only depends
+        # on the document, so the paths are kept by score and sorted, and a search reads just the best ones
+        self.prefixes = {}
+        for categories, pwd in passwords:
+            self.__add(categories + (pwd.name,), pwd, list.append)
+        for buckets in self.prefixes.values():
+            for paths in buckets.values():
+                paths.sort()
+
+    def add(self, path, pwd):
+        self.__add(path, pwd, bisect.insort)
+
+    def __add(self, path, pwd, insert):
+        # the texts of the fields, in the order of FIELD_WEIGHTS
+        texts = self.documents[path] = tuple(document_fields(path, pwd).values())
+        for text in texts:
+            for ngram in ngrams(text):
+                self.ngrams.setdefault(ngram, set()).add(path)
+        for prefix in set().union(*map(token_prefixes, texts)):
+            insert(self.prefixes.setdefault(prefix, {}).setdefault(score_texts(texts, prefix), []), path)
+
+    def remove(self, path):
+        texts = self.documents.pop(path, None)
+        if texts is None:
+            return
+        for text in texts:
+            for ngram in ngrams(text):
+                self.__discard(self.ngrams, ngram, path)
+        for prefix in set().union(*map(token_prefixes, texts)):
+            buckets = self.prefixes[prefix]
+            score = score_texts(texts, prefix)
+            paths = buckets[score]
+            del paths[bisect.bisect_left(paths, path)]
+            if not paths:
+                del buckets[score]
+                if not buckets:
+                    del self.prefixes[prefix]
+
+    def update(self, path, old, new):
+        if old is not None:
+            self.remove(path)
+        if new is not None:
+            self.add(path, new)
+
+    def search(self, query, limit=None):
+        # the paths of the matches, best first. With a limit only the best ones are kept instead of sorting all
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        if len(query) < NGRAM_SIZE:
+            results = []
+            buckets = self.prefixes.get(query, {})
+            for score in sorted(buckets, reverse=True):
+                paths = buckets[score]
+                results += paths if limit is None else paths[:limit - len(results)]
+                if limit is not None and len(results) >= limit:
+                    break
+            return results
+
+        postings = sorted((self.ngrams.get(ngram, set()) for ngram in ngrams(query)), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        documents = self.documents
+        results = []
+        for path in candidates:
+            score = score_texts(documents[path], query)
+            if score:
+                results.append((-score, path))
+        if limit is None:
+            results.sort()
+        else:
+            results = heapq.nsmallest(limit, results)
+        return [path for _, path in results]
+
+    @staticmethod
+    def __discard(index, key, path):
+        paths = index.get(key)
+        if paths is None:
+            return False
+        paths.discard(path)
+        if not paths:
+            del index[key]
@@ -1,113 +1,589 @@
-import json
+import array
+import atexit
+import base64
+import bisect
+import contextlib
+import gc
+import io
+import itertools
 import os
+import shutil
 import sys
+import threading
 import time
 
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
 import pwdsync.crypto as crypto
 import pwdsync.exceptions as exceptions
+import pwdsync.fastjson as fastjson
 import pwdsync.utils as utils
-from pwdsync.config import config
-from pwdsync.history_events import HistoryEvent, AddEvent, EditEvent
+from collections import namedtuple
 
+from pwdsync.config import config, get_device_id
+from pwdsync.history_events import HistoryEvent, AddEvent, EditEvent, merge_histories, find_conflicts
+from pwdsync.history_index import HistoryIndex
+from pwdsync.history_log import HistoryLog, LOG_SUFFIX
+from pwdsync.password import SECRET_FIELDS, Password, Sealed
+from pwdsync.path_index import PathIndex
+from pwdsync.search import SearchIndex
+from pwdsync.trie import Trie
 
-def load_encrypted_data(path=None):
-    if not path:
-        path = utils.get_pwdsync_file(config.password_file_path)
-    if not os.path.isfile(path):
-        return None
-    with open(path) as f:
-        return f.read()
 
+RECORD_HISTORY = "history"
+RECORD_PASSWORD = "password"
+RECORD_BASE_EVENT = "base_event"
+RECORD_BASE_PASSWORD = "base_password"
+RECORD_BASE_FOLDED = "base_folded"
+SECONDS_PER_DAY = 24 * 60 * 60
+# larger vaults are streamed from disk instead of being kept in memory until the password is entered
+PRELOAD_MAX_SIZE = 64 * 1024 * 1024
+
+TEMP_SUFFIX = ".tmp"
+BACKUP_SUFFIX = ".bak"
+LOCK_SUFFIX = ".lock"
+
+PreloadedVault = namedtuple("PreloadedVault", "path stat data")
+EvictedVault = namedtuple("EvictedVault", "header data")
+# what a save writes, passwords is a copy of the tree if it writes a snapshot and None if it only appends to the log
+SaveView = namedtuple("SaveView", "filepath history passwords base")
+
+
+def kdf_params():
+    return crypto.KdfParams(config.kdf_n, config.kdf_r, config.kdf_p)
+
+
+def vault_path(path=None):
+    return path or utils.get_pwdsync_file(config.password_file_path)
 
-def json_object_hook(dct):
-    if "password" in dct:
-        return Password.from_json(dct)
-    elif "event" in dct:
-        return HistoryEvent.from_json(dct)
-    return dct
 
+def file_stat(filepath):
+    stat = os.stat(filepath)
+    return stat.st_mtime_ns, stat.st_size
 
-class PwdJsonEncoder(json.JSONEncoder):
-    # pylint: disable=E0202
-    def default(self, obj):
-        if isinstance(obj, Password) or isinstance(obj, HistoryEvent):
-            return obj.__dict__
-        return json.JSONEncoder.default(self, obj)
+
+def vault_stat(path=None):
+    # changes whenever the vault or its log is written
+    filepath = vault_path(path)
+    return [file_stat(filepath) if os.path.exists(filepath) else None for filepath in (filepath, filepath + LOG_SUFFIX)]
+
+
+def preload_vault(path=None):
+    # reads, decodes and validates the vault, which does not need the password and can run while it is typed
+    filepath = vault_path(path)
+    if not os.path.isfile(filepath):
+        return None
+    stat = file_stat(filepath)
+    if not stat[1] or stat[1] > PRELOAD_MAX_SIZE:
+        return None
+
+    with open(filepath, "rb") as f:
+        f = crypto.unarmor(f)
+        crypto.validate_header(f)
+        data = f.read()
+    return PreloadedVault(filepath, stat, data)
+
+
+def rotate_backups(filepath, count):
+    # .bak1 is the newest, the current file is linked instead of moved so it never disappears
+    for i in range(count, 1, -1):
+        older = "{}{}{}".format(filepath, BACKUP_SUFFIX, i - 1)
+        if os.path.exists(older):
+            os.replace(older, "{}{}{}".format(filepath, BACKUP_SUFFIX, i))
+    newest = filepath + BACKUP_SUFFIX + "1"
+    if os.path.exists(newest):
+        os.remove(newest)
+    try:
+        os.link(filepath, newest)
+    except OSError:
+        shutil.copy2(filepath, newest)
+
+
+@contextlib.contextmanager
+def vault_lock(filepath):
+    # advisory, keeps two instances from saving at the same time
+    if not HAS_FCNTL or not config.lock_vault:
+        yield
+        return
+    with open(filepath + LOCK_SUFFIX, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def open_vault(filepath, preloaded=None):
+    if preloaded is not None and preloaded.path == filepath and preloaded.stat == file_stat(filepath):
+        return io.BytesIO(preloaded.data)
+    return open(filepath, "rb")
+
+
+def to_json_default(obj):
+    if isinstance(obj, Password) or isinstance(obj, HistoryEvent):
+        return obj.to_json()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def is_password_json(dct):
+    # a category that contains an entry called "password" maps it to a dict, a sealed password is {"sealed": DATA}
+    if "password" not in dct:
+        return False
+    value = dct["password"]
+    return not isinstance(value, dict) or (len(value) == 1 and isinstance(value.get("sealed"), str))
+
+
+def passwords_from_json(dct):
+    if is_password_json(dct):
+        return Password.from_json(dct)
+    return {key: passwords_from_json(value) for key, value in dct.items()}
 
 
 def from_json(data):
-    return json.loads(data, object_hook=json_object_hook)
+    with utils.gc_paused():
+        data = fastjson.loads(data)
+        return {
+            "history": [HistoryEvent.from_json(event) for event in data["history"]],
+            "passwords": {key: passwords_from_json(value) for key, value in data["passwords"].items()}
+        }
 
 
 def to_json(data):
-    return json.dumps(data, cls=PwdJsonEncoder)
+    return fastjson.dumps(data, default=to_json_default).decode()
+
+
+def convert_password(pwd, convert, seen):
+    if id(pwd) not in seen:
+        seen.add(id(pwd))
+        pwd.password = convert(pwd.password)
+        pwd.password2 = convert(pwd.password2)
+
+
+def convert_event(event, convert, seen):
+    if id(event) in seen:
+        return
+    seen.add(id(event))
+    if isinstance(event, AddEvent):
+        convert_password(event.pwd, convert, seen)
+    elif isinstance(event, EditEvent) and event.key in SECRET_FIELDS:
+        event.value = convert(event.value)
+
+
+def copy_tree(category):
+    return {key: copy_tree(value) if isinstance(value, dict) else value for key, value in category.items()}
+
+
+def iter_passwords(category, path=()):
+    for key, value in category.items():
+        if isinstance(value, Password):
+            yield path, value
+        else:
+            yield from iter_passwords(value, path + (key,))
+
+
+def to_record(*fields):
+    return fastjson.dumps(fields) + b"\n"
+
+
+def iter_records(base, history, passwords):
+    if base.event is not None:
+        yield to_record(RECORD_BASE_EVENT, base.event.to_json())
+        if base.folded is not None:
+            yield to_record(RECORD_BASE_FOLDED, encode_folded(base.folded))
+        for path, pwd in iter_passwords(base.passwords):
+            yield to_record(RECORD_BASE_PASSWORD, "/".join(path), pwd.to_json())
+    for event in history:
+        yield to_record(RECORD_HISTORY, event.to_json())
+    for path, pwd in iter_passwords(passwords):
+        yield to_record(RECORD_PASSWORD, "/".join(path), pwd.to_json())
+
+
+def read_lines(chunks):
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
 
+class Checkpoint:
+    def __init__(self, passwords=None, event=None, count=0, folded=None):
+        self.passwords = {} if passwords is None else passwords
+        # the last event whose changes are included and the number of history events covered
+        self.event = event
+        self.count = count
+        # for the base, the sorted first 8 bytes of the ids of the compacted events. None if it was compacted before
+        # they were recorded
+        self.folded = folded
 
-class Password:
-    def __init__(self, name, username, password, password2=None, comment=None):
-        self.name = name
-        self.username = username
-        self.password = password
-        self.password2 = password2
-        self.comment = comment
+    def is_folded(self, event_id):
+        if self.folded is None:
+            return True
+        prefix = folded_prefix(event_id)
+        index = bisect.bisect_left(self.folded, prefix)
+        return index < len(self.folded) and self.folded[index] == prefix
 
-    @staticmethod
-    def from_json(json_obj):
-        for key in ("name", "username", "password"):
-            if key not in json_obj:
-                raise ValueError("{} not specified".format(key))
 
-        return Password(
-            json_obj["name"],
-            json_obj["username"],
-            json_obj["password"],
-            json_obj.get("password2", None),
-            json_obj.get("comment", None))
+def folded_prefix(event_id):
+    return int(event_id[:16], 16)
 
-    def __str__(self):
-        return "{}\t\t{}".format(self.name, self.username)
+
+def encode_folded(folded):
+    # little endian, so the file reads the same on every machine
+    folded = array.array("Q", folded)
+    if sys.byteorder == "big":
+        folded.byteswap()
+    return base64.b64encode(folded.tobytes()).decode()
+
+
+def decode_folded(data):
+    folded = array.array("Q")
+    folded.frombytes(base64.b64decode(data))
+    if sys.byteorder == "big":
+        folded.byteswap()
+    return folded
 
 
 class Storage:
     def __init__(self):
-        self.pwd = None
+        self.session = crypto.KeySession()
         self.history = []
         self.passwords = {}
+        # base holds the changes of compacted events, history starts right after it
+        self.base = Checkpoint()
+        self.checkpoint = Checkpoint()
+        # built on first use and kept up to date by set_pwd afterwards
+        self.path_index = None
+        self.path_trie = None
+        self.search_index = None
+        # builds the search index in the background after unlocking, with the changes made in the meantime
+        self.search_build = None
+        self.search_changes = []
+        # built on the first history query and extended by the following ones
+        self.history_index = None
+        self.log = None
+        self.saved_events = 0
+        self.needs_snapshot = True
+        # the encrypted state while locked by evict
+        self.evicted = None
+        # writes saves in the background, started by the first one
+        self.saver = None
+        # path and vault_stat of the file as it was last loaded or saved
+        self.loaded_stat = None
+        # seconds the last load, save, lock and unlock took
+        self.timings = {}
 
     def save_data(self, filepath=None):
-        if not self.pwd:
+        self.flush_saves()
+        self.write_save(self.save_view(filepath))
+
+    def save_in_background(self):
+        # returns right away, errors are collected by the saver
+        if self.saver is None:
+            self.saver = Saver(self)
+        self.saver.submit()
+
+    def flush_saves(self):
+        # waits for background saves, raising the first error of the ones that failed
+        if self.saver is not None:
+            self.saver.flush()
+            errors = self.saver.pop_errors()
+            if errors:
+                raise errors[0]
+
+    def save_view(self, filepath=None, snapshot=False):
+        # everything a save writes, copied so the storage can keep changing while it is written
+        if not self.session.unlocked:
             raise exceptions.PwdSyncException("Failed to save data: No password")
 
-        if not filepath:
-            filepath = utils.get_pwdsync_file(config.password_file_path)
+        filepath = vault_path(filepath)
+        snapshot = (snapshot or self.needs_snapshot or self.log is None or self.log.path != filepath + LOG_SUFFIX or
+                    self.log.size >= config.max_log_size * 1024)
+        self.needs_snapshot = False
+        return SaveView(filepath, list(self.history), copy_tree(self.passwords) if snapshot else None, self.base)
+
+    def write_save(self, view):
+        # the log, saved_events and loaded_stat are only changed here, so saves must not run at the same time
+        start = time.perf_counter()
+        try:
+            with vault_lock(view.filepath):
+                if self.loaded_stat is not None and self.loaded_stat[0] == view.filepath and \
+                        vault_stat(view.filepath) != self.loaded_stat[1]:
+                    raise exceptions.PwdSyncException("The password file was changed by another instance of PwdSync. "
+                                                      "Restart or merge it to keep both changes")
+                synced = self.__write_save(view)
+                self.loaded_stat = view.filepath, vault_stat(view.filepath)
+        except BaseException:
+            if view.passwords is not None:
+                self.needs_snapshot = True
+            raise
+        self.timings["save"] = time.perf_counter() - start
+        self.timings["fsync"] = synced
+
+    def __write_save(self, view):
+        # returns the seconds spent in fsync
+        synced = 0
+        if view.passwords is not None:
+            snapshot_id, synced = self.write_snapshot(view.filepath, backups=config.backup_count,
+                                                      records=iter_records(view.base, view.history, view.passwords))
+            self.log = HistoryLog(view.filepath, self.session, snapshot_id)
+            self.log.reset()
+            count = len(view.history)
+            # only if the history didn't change in front of the saved events since the view was taken
+            if self.base is view.base and (not count or (len(self.history) >= count and
+                                                         self.history[count - 1] is view.history[-1])):
+                self.checkpoint = Checkpoint(view.passwords, view.history[-1] if count else view.base.event, count)
+        elif len(view.history) > self.saved_events:
+            synced = self.log.append(b"".join(to_record(RECORD_HISTORY, event.to_json())
+                                              for event in view.history[self.saved_events:]))
+        self.saved_events = len(view.history)
+        return synced
+
+    def write_snapshot(self, filepath, armor=False, backups=0, records=None):
+        # written next to the file and renamed over it, so a crash leaves either the old or the new file
+        if not self.session.unlocked:
+            raise exceptions.PwdSyncException("Failed to save data: No password")
 
-        data = {
-            "history": self.history,
-            "passwords": self.passwords
-        }
-        encrypted = crypto.encrypt(to_json(data), self.pwd)
-        with open(filepath, "w") as f:
-            f.write(encrypted)
-
-    def load_data(self, pwd, path=None):
-        self.pwd = crypto.sha256(pwd)
-        encrypted = load_encrypted_data(path)
-        if encrypted:
-            decrypted = crypto.decrypt(encrypted, self.pwd)
-            data = from_json(decrypted)
-        elif not path and config.test:
-            with open("test_data.json") as f:
-                data = json.load(f, object_hook=json_object_hook)
-        else:
+        temp_path = filepath + TEMP_SUFFIX
+        try:
+            with open(temp_path, "wb") as f:
+                with crypto.VaultWriter(f, self.session, armor) as writer:
+                    for record in records or self.iter_records():
+                        writer.write(record)
+                synced = utils.fsync(f)
+            if backups and os.path.isfile(filepath):
+                rotate_backups(filepath, backups)
+            os.replace(temp_path, filepath)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+        synced += utils.fsync_dir(os.path.dirname(os.path.abspath(filepath)))
+        return writer.header.nonce, synced
+
+    def load_data(self, pwd, path=None, preloaded=None):
+        start = time.perf_counter()
+        try:
+            self.__load_data(pwd, path, preloaded)
+        finally:
+            self.timings["load"] = time.perf_counter() - start
+
+    def __load_data(self, pwd, path, preloaded):
+        self.flush_saves()
+        # without a password the key of the current session is used
+        pwd = crypto.sha256(pwd) if pwd is not None else None
+        filepath = vault_path(path)
+        self.evicted = None
+        self.log = None
+        self.needs_snapshot = True
+        self.base = Checkpoint()
+        self.invalidate_indexes()
+        if os.path.isfile(filepath) and os.path.getsize(filepath):
+            with open_vault(filepath, preloaded) as f:
+                reader = crypto.VaultReader(f, self.session, pwd)
+                if reader.version == crypto.SINGLE_SEGMENT_VERSION:
+                    data = from_json(b"".join(reader))
+                    self.history = data["history"]
+                    self.passwords = data["passwords"]
+                    self.take_checkpoint()
+                else:
+                    self.load_records(read_lines(reader))
+                    self.take_checkpoint()
+                    self.log = HistoryLog(filepath, self.session, reader.header.nonce)
+                    self.load_log()
+                    self.needs_snapshot = False
+            if self.seal_plaintext():
+                # written by a version that kept the secrets in plaintext
+                self.needs_snapshot = True
+            self.saved_events = len(self.history)
+            self.loaded_stat = filepath, vault_stat(filepath)
+            return
+
+        if pwd is None:
+            raise exceptions.WrongPasswordException()
+        self.session.unlock(pwd, params=kdf_params())
+        self.loaded_stat = filepath, vault_stat(filepath)
+        if path or not config.test:
             return
+        with open("test_data.json", "rb") as f:
+            data = from_json(f.read())
         self.history = data["history"]
         self.passwords = data["passwords"]
+        self.seal_plaintext()
+        self.take_checkpoint()
+
+    def iter_records(self):
+        return iter_records(self.base, self.history, self.passwords)
+
+    def load_records(self, lines):
+        self.history = []
+        self.passwords = {}
+        self.invalidate_indexes()
+        with utils.gc_paused():
+            self.__load_records(lines)
+
+    def __load_records(self, lines):
+        # passwords that weren't edited since they were added share the object of their add event
+        added = {}
+        for line in lines:
+            record = fastjson.loads(line)
+            if record[0] == RECORD_HISTORY:
+                event = HistoryEvent.from_json(record[1])
+                self.history.append(event)
+                if isinstance(event, AddEvent):
+                    added[event.categories, event.name] = event.pwd
+            elif record[0] == RECORD_PASSWORD:
+                pwd = added.get((record[1], record[2]["name"]))
+                if pwd is None or pwd.to_json() != record[2]:
+                    pwd = Password.from_json(record[2])
+                self.get_category(*utils.split_path(record[1]), create=True)[pwd.name] = pwd
+            elif record[0] == RECORD_BASE_EVENT:
+                self.base.event = HistoryEvent.from_json(record[1])
+            elif record[0] == RECORD_BASE_FOLDED:
+                self.base.folded = decode_folded(record[1])
+            elif record[0] == RECORD_BASE_PASSWORD:
+                pwd = Password.from_json(record[2])
+                category = self.base.passwords
+                for key in utils.split_path(record[1]):
+                    category = category.setdefault(key, {})
+                category[pwd.name] = pwd
+            else:
+                raise ValueError("Invalid record type: " + repr(record[0]))
+
+    def load_log(self):
+        for line in read_lines(self.log.read()):
+            record = fastjson.loads(line)
+            if record[0] != RECORD_HISTORY:
+                raise ValueError("Invalid log record type: " + repr(record[0]))
+            event = HistoryEvent.from_json(record[1])
+            self.history.append(event)
+            event.apply(self)
+
+    def lock(self):
+        if self.saver is not None:
+            # a pending save still needs the key
+            self.saver.flush()
+        self.session.lock()
+
+    @property
+    def locked(self):
+        return self.evicted is not None
+
+    def evict(self):
+        # only an encrypted copy of the current state is kept, so unsaved changes survive
+        if self.saver is not None:
+            self.saver.flush()
+        start = time.perf_counter()
+        f = io.BytesIO()
+        with crypto.VaultWriter(f, self.session) as writer:
+            for record in self.iter_records():
+                writer.write(record)
+        self.evicted = EvictedVault(writer.header, f.getbuffer()[len(writer.header.data):])
+
+        self.history = []
+        self.passwords = {}
+        self.base = Checkpoint()
+        self.checkpoint = Checkpoint()
+        self.invalidate_indexes()
+        self.session.lock()
+        gc.collect()
+        self.timings["lock"] = time.perf_counter() - start
+
+    def unlock(self, pwd):
+        start = time.perf_counter()
+        reader = crypto.VaultReader(io.BytesIO(self.evicted.data), self.session, crypto.sha256(pwd),
+                                    self.evicted.header)
+        self.base = Checkpoint()
+        self.load_records(read_lines(reader))
+        self.take_checkpoint()
+        self.evicted = None
+        self.timings["unlock"] = time.perf_counter() - start
+
+    def check_pwd(self, pwd):
+        if not self.session.verify(crypto.sha256(pwd)):
+            raise exceptions.WrongPasswordException()
+
+    def rekey(self, pwd):
+        # pending saves are written with the old key and secrets, which are changed in place
+        self.flush_saves()
+        old = crypto.KeySession()
+        old.key = bytearray(self.session.key)
+        self.session.unlock(crypto.sha256(pwd), params=kdf_params())
+        try:
+            self.convert_secrets(lambda value: self.reseal(value, old))
+        finally:
+            old.lock()
+        self.needs_snapshot = True
+
+    def seal(self, value):
+        # empty values stay as they are, they mean the field is not set
+        if isinstance(value, str) and value:
+            return Sealed(crypto.seal_secret(self.session, value))
+        return value
+
+    def reseal(self, value, session):
+        if isinstance(value, Sealed):
+            return self.seal(crypto.unseal_secret(session, value.data))
+        return self.seal(value)
+
+    def reveal(self, pwd, field="password"):
+        value = getattr(pwd, field)
+        if isinstance(value, Sealed):
+            return crypto.unseal_secret(self.session, value.data)
+        return value
+
+    def seal_plaintext(self):
+        count = 0
+
+        def seal(value):
+            nonlocal count
+            if isinstance(value, str) and value:
+                count += 1
+                return self.seal(value)
+            return value
+        self.convert_secrets(seal)
+        return count
+
+    def convert_secrets(self, convert, events=None):
+        # in place, the objects are shared between the history, the tree and the checkpoints
+        seen = set()
+        if events is not None:
+            for event in events:
+                convert_event(event, convert, seen)
+            return
+
+        for event in itertools.chain(self.history, (self.base.event, self.checkpoint.event)):
+            if event is not None:
+                convert_event(event, convert, seen)
+        for tree in (self.passwords, self.base.passwords, self.checkpoint.passwords):
+            for _, pwd in iter_passwords(tree):
+                convert_password(pwd, convert, seen)
 
     def get_pwd(self, *pwd):
-        pwd = self.get_category(*pwd[:-1]).get(pwd[-1])
-        if isinstance(pwd, Password):
-            return pwd
-        return None
+        return (self.path_index or self.get_path_index()).get(pwd)
+
+    def get_path_index(self):
+        if self.path_index is None:
+            self.path_index = PathIndex(self.passwords)
+        return self.path_index
+
+    def list_category(self, *categories):
+        index = self.get_path_index()
+        if not index.is_category(categories):
+            return None
+        return list(index.entries(categories))
+
+    def iter_category(self, *categories):
+        index = self.get_path_index()
+        if not index.is_category(categories):
+            return iter(())
+        return index.walk(categories)
 
     def get_category(self, *categories, create=False):
         category = self.passwords
@@ -122,31 +598,272 @@ class Storage:
             category = category[key]
         return category
 
+    def set_pwd(self, path, pwd):
+        category = self.get_category(*path[:-1], create=True)
+        old = category.get(path[-1])
+        category[path[-1]] = pwd
+        if self.path_index is not None:
+            self.path_index.update(tuple(path), old, pwd)
+        if self.path_trie is not None and old is None:
+            self.path_trie.add("/".join(path))
+        if self.search_index is not None:
+            self.search_index.update(tuple(path), old, pwd)
+        elif self.search_build is not None:
+            self.search_changes.append((tuple(path), old, pwd))
+
+    def search(self, query, limit=None):
+        return self.get_search_index().search(query, limit)
+
+    def get_search_index(self):
+        if self.search_index is None and self.search_build is not None:
+            index = self.search_build.result()
+            for change in self.search_changes:
+                index.update(*change)
+            self.search_index = index
+            self.search_build = None
+            self.search_changes = []
+        elif self.search_index is None:
+            self.search_index = SearchIndex(iter_passwords(self.passwords))
+        return self.search_index
+
+    def build_search_index_in_background(self):
+        # the thread gets a list of the passwords, so it never sees the tree change while it runs
+        if self.search_index is None and self.search_build is None:
+            self.search_build = utils.BackgroundCall(SearchIndex, list(iter_passwords(self.passwords)))
+
+    def find_pwds(self, query):
+        # exact path, else every path it is a prefix of, else every fuzzy match
+        if self.get_pwd(*utils.split_path(query)) is not None:
+            return [tuple(utils.split_path(query))]
+        matches = list(self.get_path_trie().complete(query)) or list(self.path_trie.fuzzy(query))
+        return [tuple(utils.split_path(match)) for match in matches]
+
+    def complete_path(self, prefix):
+        return list(self.get_path_trie().complete(prefix, "/"))
+
+    def get_path_trie(self):
+        if self.path_trie is None:
+            self.path_trie = Trie("/".join(path) for path in self.get_path_index().passwords)
+        return self.path_trie
+
+    def query_history(self, *path, since=None, until=None, key=None):
+        return self.get_history_index().query("/".join(path), since, until, key)
+
+    def get_history_index(self):
+        if self.history_index is None or not self.history_index.is_current(self.history):
+            self.history_index = HistoryIndex(self.history)
+        else:
+            self.history_index.update()
+        return self.history_index
+
+    def invalidate_indexes(self):
+        self.path_index = None
+        self.path_trie = None
+        self.search_index = None
+        self.search_build = None
+        self.search_changes = []
+        self.history_index = None
+
+    def next_clock(self):
+        # the history is ordered by clock, so its last event has the highest one
+        last = self.history[-1] if self.history else self.base.event
+        return 1 + (last.clock if last is not None else 0)
+
     def add_pwd(self, pwd, *categories):
-        event = AddEvent(categories, pwd.name, pwd)
+        # the caller keeps its own object, the stored one is never changed in place
+        event = AddEvent(categories, pwd.name, pwd.replace(password=self.seal(pwd.password),
+                                                           password2=self.seal(pwd.password2)),
+                         clock=self.next_clock(), device=get_device_id())
         self.history.append(event)
         event.apply(self)
 
+    def add_pwds(self, entries):
+        # a whole batch of (categories, Password) is added to the history at once
+        clock = self.next_clock()
+        device = get_device_id()
+        events = [AddEvent(categories, pwd.name, pwd.replace(password=self.seal(pwd.password),
+                                                             password2=self.seal(pwd.password2)),
+                           clock=clock + i, device=device) for i, (categories, pwd) in enumerate(entries)]
+        self.history.extend(events)
+        for event in events:
+            event.apply(self)
+
     def edit_pwd(self, key, value, *pwd_path):
         pwd = self.get_pwd(*pwd_path)
-        if not hasattr(pwd, key):
+        if pwd is None or key not in Password.__slots__:
             raise KeyError("Invalid key")
 
-        event = EditEvent(pwd_path[:-1], pwd.name, key, value)
+        if key in SECRET_FIELDS:
+            value = self.seal(value)
+        event = EditEvent(pwd_path[:-1], pwd.name, key, value, clock=self.next_clock(), device=get_device_id())
         self.history.append(event)
         event.apply(self)
 
-    def merge(self, other):
-        self.__merge_history(other.history)
-        self.__build_from_history()
-
-    def __merge_history(self, history):
-        self.history = list(sorted(set(self.history + history)))
-
-    def __build_from_history(self):
-        self.passwords = {}
-        for event in self.history:
-            event.apply(self)
+    def take_checkpoint(self):
+        event = self.history[-1] if self.history else self.base.event
+        self.checkpoint = Checkpoint(copy_tree(self.passwords), event, len(self.history))
+
+    def merge(self, other, unseen=None):
+        # unseen are the local events the other side doesn't know, by default those missing from its history
+        if other.base.event is not None and not self.__knows(other.base.event):
+            raise exceptions.PwdSyncException("The other database was compacted past changes missing here")
+
+        other_history = other.history
+        if self.base.event is not None:
+            # changes from before the last compaction are already part of the base, unless they never were here
+            other_history = [event for event in other_history if event > self.base.event]
+            if len(other_history) < len(other.history) and not all(
+                    self.base.is_folded(event.id) for event in other.history if event <= self.base.event):
+                raise exceptions.PwdSyncException("The other database has changes from before the last compaction "
+                                                  "that are missing here")
+        result = merge_histories(self.history, other_history)
+        local = set(map(id, self.history))
+        new = [event for event in result.history[result.diverged:] if id(event) not in local]
+        if other.session.key != self.session.key:
+            # events that are new here carry secrets sealed under the key of the other database
+            self.convert_secrets(lambda value: self.reseal(value, other.session), new)
+
+        if unseen is None:
+            known = {event.id for event in other.history}
+            unseen = [event for event in self.history if event.id not in known and
+                      (other.base.event is None or event > other.base.event)]
+        conflicts = [conflict for conflict in find_conflicts(unseen, new)
+                     if not self.same_change(conflict.winner, conflict.loser)]
+
+        # a diverged of 0 can also mean the local events were reordered, which needs a full replay
+        if result.diverged == len(self.history) or (result.diverged and
+                                                    commutes(result.history[result.diverged:], local)):
+            # the new events don't touch fields that local events after them changed, so they can go on top
+            for event in new:
+                event.apply(self)
+        else:
+            start = self.checkpoint if self.checkpoint.count <= result.diverged else self.base
+            replayed = replay(start.passwords, result.history[start.count:])
+            self.passwords = replayed.passwords
+            self.invalidate_indexes()
+            self.path_index = replayed.path_index
+        if result.diverged < len(result.history):
+            self.needs_snapshot = True
+        self.history = result.history
+        if result.diverged < self.checkpoint.count:
+            # events were put in front of the checkpoint, so it no longer is the state after its part of the history
+            self.take_checkpoint()
+        if self.loaded_stat is not None and other.loaded_stat is not None and \
+                os.path.realpath(other.loaded_stat[0]) == os.path.realpath(self.loaded_stat[0]):
+            # a save still running would set loaded_stat after this
+            if self.saver is not None:
+                self.saver.flush()
+            # everything in the file is here now, so the next save may replace it, but not append to its old log
+            self.loaded_stat = other.loaded_stat
+            self.needs_snapshot = True
+        return result._replace(conflicts=conflicts)
+
+    def same_change(self, first, second):
+        if isinstance(first, AddEvent):
+            return all(self.reveal(first.pwd, key) == self.reveal(second.pwd, key) for key in Password.__slots__)
+        if first.key in SECRET_FIELDS:
+            return self.reveal(first, "value") == self.reveal(second, "value")
+        return first.value == second.value
+
+    def compact(self, retention_days):
+        # a pending save would append the events from saved_events on to the log, which is reset below
+        self.flush_saves()
+        cutoff = int(time.time()) - retention_days * SECONDS_PER_DAY
+        # ordered by clock, so an older event after a newer one stays in the history for now
+        count = next((i for i, event in enumerate(self.history) if event.time >= cutoff), len(self.history))
+        if count == 0:
+            return 0
+
+        folded = None
+        if self.base.event is None or self.base.folded is not None:
+            folded = sorted(itertools.chain(self.base.folded or (),
+                                            (folded_prefix(event.id) for event in self.history[:count])))
+        self.base = Checkpoint(replay(self.base.passwords, self.history[:count]).passwords, self.history[count - 1],
+                               folded=array.array("Q", folded) if folded is not None else None)
+        self.history = self.history[count:]
+        self.take_checkpoint()
+        self.saved_events = 0
+        self.needs_snapshot = True
+        return count
+
+    def __knows(self, event):
+        if self.base.event is not None and event <= self.base.event:
+            return True
+        return event in set(self.history)
+
+
+def commutes(events, local):
+    # whether the events that are not local can be applied after all local ones instead of at their position
+    later_fields = set()
+    later_paths = set()
+    for event in reversed(events):
+        path = event.categories, event.name
+        if id(event) in local:
+            later_fields.add((path, getattr(event, "key", None)))
+            later_paths.add(path)
+        elif isinstance(event, AddEvent):
+            if path in later_paths:
+                return False
+        elif (path, event.key) in later_fields or (path, None) in later_fields:
+            return False
+    return True
+
+
+class Saver(threading.Thread):
+    # writes the saves of a storage one after another, a save that is still waiting is replaced by a newer one
+    def __init__(self, storage):
+        super().__init__(daemon=True)
+        self.storage = storage
+        self.condition = threading.Condition()
+        self.pending = None
+        self.busy = False
+        self.errors = []
+        self.start()
+
+    def submit(self):
+        with self.condition:
+            # the newer save includes all changes of the waiting one, but not a snapshot it would have written
+            snapshot = self.pending is not None and self.pending.passwords is not None
+            self.pending = self.storage.save_view(snapshot=snapshot)
+            self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            while self.pending is not None or self.busy:
+                self.condition.wait()
+
+    def pop_errors(self):
+        with self.condition:
+            errors = self.errors
+            self.errors = []
+        return errors
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                view = self.pending
+                self.pending = None
+                self.busy = True
+            try:
+                self.storage.write_save(view)
+            except Exception as e:
+                with self.condition:
+                    self.errors.append(e)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+
+def replay(passwords, events):
+    scratch = Storage()
+    scratch.passwords = copy_tree(passwords)
+    for event in events:
+        event.apply(scratch)
+    return scratch
 
 
 storage = Storage()
+atexit.register(storage.lock)
@@ -0,0 +1,311 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+
+import pwdsync.crypto as crypto
+import pwdsync.exceptions as exceptions
+import pwdsync.fastjson as fastjson
+import pwdsync.utils as utils
+from collections import namedtuple
+
+from pwdsync.history_events import HistoryEvent, sort_key
+from pwdsync.password import Sealed
+from pwdsync.storage import Storage
+
+SYNC_STATE_NAME = "sync.json"
+SERVER_LOG_NAME = "events.jsonl"
+DEFAULT_PORT = 7123
+AUTH_INFO = b"PwdSync sync auth"
+# a message is a single line, the first sync sends the whole history in one
+STREAM_LIMIT = 256 * 1024 * 1024
+
+HELLO = "hello"
+SYNC = "sync"
+PUSH = "push"
+
+SyncResult = namedtuple("SyncResult", "pulled pushed sent received conflicts")
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
+
+
+def encode(message):
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+def auth_token(session):
+    return hmac.new(bytes(session.key), AUTH_INFO, hashlib.sha256).hexdigest()
+
+
+class SyncServer:
+    # only ever sees event ids and encrypted events, never the password or the key
+    def __init__(self, directory):
+        self.path = os.path.join(directory, SERVER_LOG_NAME)
+        # salt and kdf params of the sync key and the hash of the auth token, set by the first sync
+        self.account = None
+        # [id, data] in the order they arrived, a client's cursor is an index into it
+        self.events = []
+        self.ids = set()
+        if os.path.isfile(self.path):
+            self.load()
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # torn write, the client didn't get an answer and sends the events again
+                    break
+                record = json.loads(line.decode())
+                if record[0] == "account":
+                    self.account = record[1]
+                else:
+                    self.events.append(record[1:])
+                    self.ids.add(record[1])
+
+    def write(self, records):
+        with open(self.path, "ab") as f:
+            f.write(b"".join(encode(record) for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(encode(self.respond(json.loads(line.decode()))))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, message):
+        command = message.get("command")
+        if command == HELLO:
+            return {"account": self.account and {"salt": self.account["salt"], "params": self.account["params"]}}
+        if command not in (SYNC, PUSH):
+            return {"error": "Unknown command"}
+        if not self.authorize(message):
+            return {"error": "Wrong password", "auth": False}
+
+        pushed = self.add(message.get("events", []))
+        if command == PUSH:
+            return {"cursor": len(self.events)}
+
+        have = message.get("have")
+        if have is not None:
+            have = set(have)
+            events = [event for event in self.events if event[0] not in have]
+            missing = [id for id in have if id not in self.ids]
+        else:
+            since = message.get("since", 0)
+            if since > len(self.events):
+                return {"error": "Unknown cursor", "reset": True}
+            events = [event for event in self.events[since:] if event[0] not in pushed]
+            missing = []
+        return {"events": events, "missing": missing, "cursor": len(self.events)}
+
+    def authorize(self, message):
+        token = hashlib.sha256(message.get("token", "").encode()).hexdigest()
+        if self.account is None:
+            if "salt" not in message or "params" not in message:
+                return False
+            self.account = {"salt": message["salt"], "params": message["params"], "token": token}
+            self.write([["account", self.account]])
+            return True
+        return hmac.compare_digest(token, self.account["token"])
+
+    def add(self, events):
+        new = [event for event in events if event[0] not in self.ids]
+        self.events.extend(new)
+        self.ids.update(event[0] for event in new)
+        if new:
+            self.write([["event"] + event for event in new])
+        return {event[0] for event in events}
+
+
+async def serve(directory, address="localhost:{}".format(DEFAULT_PORT)):
+    host, port = parse_address(address)
+    server = SyncServer(directory)
+    async with await asyncio.start_server(server.handle, host, port, limit=STREAM_LIMIT) as listener:
+        await listener.serve_forever()
+
+
+class Connection:
+    def __init__(self, address):
+        self.address = parse_address(address)
+        self.reader = None
+        self.writer = None
+        # bytes on the wire, to show what a sync cost
+        self.sent = 0
+        self.received = 0
+
+    async def __aenter__(self):
+        self.reader, self.writer = await asyncio.open_connection(*self.address, limit=STREAM_LIMIT)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self.writer.close()
+
+    async def request(self, message):
+        data = encode(message)
+        self.writer.write(data)
+        await self.writer.drain()
+        self.sent += len(data)
+        line = await self.reader.readline()
+        if not line:
+            raise exceptions.PwdSyncException("The sync server closed the connection")
+        self.received += len(line)
+        response = json.loads(line.decode())
+        if response.get("auth") is False:
+            raise exceptions.WrongPasswordException()
+        if "error" in response and not response.get("reset"):
+            raise exceptions.PwdSyncException("Sync failed: " + response["error"])
+        return response
+
+
+def fetch_account(address):
+    async def fetch():
+        async with Connection(address) as connection:
+            return (await connection.request({"command": HELLO}))["account"]
+    return asyncio.run(fetch())
+
+
+def sync_session(pwd, account, params):
+    # the vaults of two devices have different salts, so they share a key derived from the server's salt
+    session = crypto.KeySession()
+    if account is None:
+        session.unlock(crypto.sha256(pwd), params=params)
+    else:
+        session.unlock(crypto.sha256(pwd), base64.b64decode(account["salt"]), crypto.KdfParams(*account["params"]))
+    return session
+
+
+def reseal(value, source, target):
+    if isinstance(value, Sealed):
+        return Sealed(crypto.seal_secret(target, crypto.unseal_secret(source, value.data)))
+    return value
+
+
+def encrypt_events(storage, session, events):
+    # copies, the secrets of the stored events stay sealed under the vault key
+    copies = [HistoryEvent.from_json(event.to_json()) for event in events]
+    storage.convert_secrets(lambda value: reseal(value, storage.session, session), copies)
+    return [[event.id, base64.b64encode(crypto.seal(session, fastjson.dumps(event.to_json()),
+                                                     event.id.encode())).decode()] for event in copies]
+
+
+def decrypt_events(session, records):
+    events = []
+    for id, data in records:
+        event = HistoryEvent.from_json(fastjson.loads(crypto.unseal(session, base64.b64decode(data), id.encode())))
+        if event.id != id:
+            raise exceptions.CorruptedVaultException()
+        events.append(event)
+    return events
+
+
+def load_state(address):
+    path = utils.get_pwdsync_file(SYNC_STATE_NAME)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get(address, {})
+
+
+def save_state(address, state):
+    path = utils.get_pwdsync_file(SYNC_STATE_NAME)
+    states = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            states = json.load(f)
+    states[address] = state
+    with open(path + ".tmp", "w") as f:
+        json.dump(states, f)
+    os.replace(path + ".tmp", path)
+
+
+def new_events(history, state):
+    # events after the newest one of the last sync, None if older events were added or compacted away since
+    watermark = state.get("watermark")
+    if watermark is None:
+        return None
+    watermark = tuple(watermark)
+    # new events get a higher clock than everything before them, so they are at the end
+    count = len(history)
+    while count and sort_key(history[count - 1]) > watermark:
+        count -= 1
+    if count != state["count"]:
+        return None
+    return history[count:]
+
+
+def sync(storage, address, pwd, account):
+    # pushes the events the server is missing and merges the ones it has that are missing here
+    state = load_state(address)
+    if account is None or state.get("salt") != account["salt"]:
+        state = {}
+    session = sync_session(pwd, account, storage.session.params)
+    salt = base64.b64encode(session.salt).decode()
+
+    async def exchange():
+        async with Connection(address) as connection:
+            message = {"command": SYNC, "token": auth_token(session)}
+            if account is None:
+                message.update(salt=salt, params=list(session.params))
+            events = new_events(storage.history, state)
+            if events is None:
+                message["have"] = [event.id for event in storage.history]
+            else:
+                message.update(since=state["cursor"], events=encrypt_events(storage, session, events))
+            response = await connection.request(message)
+            if response.get("reset"):
+                # the server lost events the last sync relied on
+                del message["since"], message["events"]
+                message["have"] = [event.id for event in storage.history]
+                events = None
+                response = await connection.request(message)
+
+            pushed = events
+            if response["missing"]:
+                missing = set(response["missing"])
+                pushed = [event for event in storage.history if event.id in missing]
+                push = encrypt_events(storage, session, pushed)
+                response["cursor"] = (await connection.request({"command": PUSH, "token": auth_token(session),
+                                                                "events": push}))["cursor"]
+            return response, pushed, connection.sent, connection.received
+
+    try:
+        response, pushed, sent, received = asyncio.run(exchange())
+        remote = Storage()
+        remote.session = session
+        remote.history = decrypt_events(session, response["events"])
+        # the pulled events were made without seeing the pushed ones and the other way around
+        result = storage.merge(remote, pushed or []) if remote.history else None
+    finally:
+        session.lock()
+    if result is not None:
+        storage.save_data()
+
+    newest = max(map(sort_key, storage.history), default=(0, 0, "", ""))
+    save_state(address, {"salt": salt, "cursor": response["cursor"], "watermark": newest,
+                         "count": len(storage.history)})
+    return SyncResult(result.new_remote if result else 0, len(pushed or ()), sent, received,
+                      result.conflicts if result else [])
+
+
+if __name__ == "__main__":
+    # python -m pwdsync.sync DIRECTORY [HOST:PORT]
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python -m pwdsync.sync DIRECTORY [HOST:PORT]")
+    asyncio.run(serve(*sys.argv[1:3]))
@@ -1,4 +1,3 @@
-import colorama
 import re
 import select
 import sys
@@ -9,9 +8,18 @@ import pwdsync.utils as utils
 import pwdsync.exceptions as exceptions
 from pwdsync.config import config
 
+colorama = utils.lazy_import("colorama")
+
+try:
+    import readline
+    HAS_READLINE = True
+except ImportError:
+    HAS_READLINE = False
+
 
 ASK_INDENTATION = 1
 RESPONSE_INDENTATION = 3
+COLOR_PATTERN = re.compile(r"\033\[[0-9;]*m")
 
 COLORS = {
     "black": '\033[30m',
@@ -40,7 +48,19 @@ COLORS = {
 }
 
 
+colors_initialized = False
+
+
+def init_colors():
+    # wraps stdout, so it is only done once something is printed
+    global colors_initialized
+    if not colors_initialized:
+        colorama.init()
+        colors_initialized = True
+
+
 def colorize(text, color=None):
+    init_colors()
     if color:
         text = "{" + color + "}" + text + "{endc}"
     return text.format(**COLORS)
@@ -82,7 +102,7 @@ def goodbye():
 
 
 def ask_yes_no(text, default=True):
-    result = ask(text.rstrip() + " (Y/n)" if default else " (y/N)")
+    result = ask(text.rstrip() + (" (Y/n)" if default else " (y/N)"))
     if not result:
         return default
     elif result.lower() in ("y", "j", "yes"):
@@ -90,7 +110,10 @@ def ask_yes_no(text, default=True):
     return False
 
 
-def ask(text):
+def ask(text, completer=None):
+    if HAS_READLINE:
+        readline.set_completer(readline_completer(completer) if completer else None)
+        history_length = readline.get_current_history_length()
     try:
         # color codes don't work with input on windows
         print(" " * ASK_INDENTATION + colorize("{blue}" + text.strip() + " {yellow}"), end="", flush=True)
@@ -103,6 +126,20 @@ def ask(text):
             return None
         except KeyboardInterrupt:
             return None
+    finally:
+        # only commands are kept for the up arrow, answers may contain secrets
+        if HAS_READLINE and not completer and readline.get_current_history_length() > history_length:
+            readline.remove_history_item(history_length)
+
+
+def readline_completer(completer):
+    matches = []
+
+    def complete(word, state):
+        if state == 0:
+            matches[:] = completer(readline.get_line_buffer()[:readline.get_begidx()], word)
+        return matches[state] if state < len(matches) else None
+    return complete
 
 
 def get_pass(text="Enter password:"):
@@ -124,6 +161,7 @@ def ask_pwd(check_func, text="Enter password:"):
         pwd = get_pass(text)
         try:
             check_func(pwd)
+            break
         except exceptions.WrongPasswordException:
             error("Wrong password. Try again.")
             fail_count += 1
@@ -131,11 +169,20 @@ def ask_pwd(check_func, text="Enter password:"):
         print()
 
 
+def strip_colors(text):
+    return COLOR_PATTERN.sub("", text)
+
+
 def highlightify(text, color="blue", end_color="endc"):
     return re.sub(r"\*\*(.*?)\*\*", r"{{{}}}\1{{{}}}".format(color, end_color), text)
 
 
+error_count = 0
+
+
 def error(text):
+    global error_count
+    error_count += 1
     respond(text, "red", "purple")
 
 
@@ -162,4 +209,7 @@ def flash(text):
         erase_lines()
 
 
-colorama.init()
+if HAS_READLINE:
+    readline.parse_and_bind("tab: complete")
+    # paths are completed as a whole, so only spaces separate words
+    readline.set_completer_delims(" ")
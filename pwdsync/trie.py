@@ -0,0 +1,99 @@
+class Node:
+    __slots__ = ("label", "children", "terminal")
+
+    def __init__(self, label="", terminal=False):
+        self.label = label
+        # first character of the child label -> child
+        self.children = {}
+        self.terminal = terminal
+
+
+def common_length(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class Trie:
+    # radix trie, edges hold whole substrings so unique suffixes cost a single node
+    def __init__(self, keys=()):
+        self.root = Node()
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        node = self.root
+        i = 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None:
+                node.children[key[i]] = Node(key[i:], True)
+                return
+
+            if key.startswith(child.label, i):
+                node = child
+                i += len(child.label)
+                continue
+
+            common = common_length(child.label, key[i:])
+            split = Node(child.label[:common])
+            child.label = child.label[common:]
+            split.children[child.label[0]] = child
+            node.children[key[i]] = split
+            node = split
+            i += common
+
+        node.terminal = True
+
+    def complete(self, prefix, stop=None):
+        # sorted keys starting with prefix, cut after the first stop character following it
+        node, path = self.__find(prefix)
+        if node is not None:
+            yield from self.__walk(node, path, len(prefix), stop)
+
+    def fuzzy(self, query):
+        # sorted keys that contain the characters of query in order
+        yield from self.__fuzzy(self.root, "", query, 0)
+
+    def __find(self, prefix):
+        node = self.root
+        path = ""
+        i = 0
+        while i < len(prefix):
+            child = node.children.get(prefix[i])
+            if child is None:
+                return None, None
+            if prefix.startswith(child.label, i):
+                i += len(child.label)
+            elif not child.label.startswith(prefix[i:]):
+                return None, None
+            else:
+                i = len(prefix)
+            node = child
+            path += child.label
+        return node, path
+
+    def __walk(self, node, path, start, stop):
+        if stop is not None:
+            cut = path.find(stop, start)
+            if cut != -1:
+                yield path[:cut + 1]
+                return
+        if node.terminal:
+            yield path
+        for first in sorted(node.children):
+            child = node.children[first]
+            yield from self.__walk(child, path + child.label, start, stop)
+
+    def __fuzzy(self, node, path, query, matched):
+        for char in node.label:
+            if matched < len(query) and char == query[matched]:
+                matched += 1
+        if matched == len(query):
+            yield from self.__walk(node, path, len(path), None)
+            return
+        for first in sorted(node.children):
+            child = node.children[first]
+            yield from self.__fuzzy(child, path + child.label, query, matched)
@@ -1,6 +1,10 @@
+import contextlib
+import gc
+import importlib.util
 import os
-import platform
-from pathlib import Path
+import sys
+import threading
+import time
 
 import pwdsync.exceptions
 from pwdsync.cache import cached
@@ -8,7 +12,8 @@ from pwdsync.cache import cached
 
 @cached
 def get_os():
-    return platform.system()
+    # what platform.system() returns, without importing it
+    return "Windows" if os.name == "nt" else os.uname().sysname
 
 
 @cached
@@ -43,5 +48,79 @@ def get_pwdsync_dir():
 def get_pwdsync_file(*path, create=False):
     filepath = os.path.join(get_pwdsync_dir(), *path)
     if create and not os.path.isfile(filepath):
-        Path(filepath).touch()
+        open(filepath, "a").close()
     return filepath
+
+
+def split_path(path):
+    return path.split("/") if path else []
+
+
+def lazy_import(name):
+    # the module is only executed on first attribute access
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named " + repr(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class BackgroundCall(threading.Thread):
+    def __init__(self, func, *args):
+        super().__init__(daemon=True)
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def fsync(f):
+    # returns the seconds it took, which is most of the cost of a save
+    start = time.perf_counter()
+    f.flush()
+    os.fsync(f.fileno())
+    return time.perf_counter() - start
+
+
+def fsync_dir(path):
+    # makes a rename in the directory durable, not possible on Windows
+    if is_windows():
+        return 0
+    start = time.perf_counter()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def gc_paused():
+    # loading creates many objects without cycles, so collections during it only cost time
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
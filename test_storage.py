@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Checks of merging, compaction and the vault format. Runs with pytest or on its own, exiting with 1 on failures
+
+import json
+import os
+import random
+import sys
+import tempfile
+import traceback
+
+import pwdsync.crypto as crypto
+import pwdsync.exceptions as exceptions
+from pwdsync.config import config
+from pwdsync.history_events import AddEvent, EditEvent
+from pwdsync.history_log import LOG_MAGIC, LOG_SUFFIX
+from pwdsync.password import Password
+from pwdsync.storage import (RECORD_BASE_EVENT, RECORD_BASE_FOLDED, RECORD_BASE_PASSWORD, RECORD_HISTORY,
+                             RECORD_PASSWORD, Storage, decode_folded, iter_passwords, read_lines, replay)
+
+PASSWORD = "test"
+# long before any retention period, so compact folds these events into the base
+OLD_TIME = 1500000000
+
+config.update(kdf_n=2 ** 10, kdf_r=8, kdf_p=1, backup_count=0)
+
+
+def new_storage(path=os.devnull):
+    storage = Storage()
+    storage.load_data(PASSWORD, path)
+    return storage
+
+
+def merged_state(storage, passwords):
+    return sorted((path, pwd.name, pwd.username, storage.reveal(pwd), storage.reveal(pwd, "password2"), pwd.comment)
+                  for path, pwd in iter_passwords(passwords))
+
+
+def saved_state(storage):
+    return (merged_state(storage, storage.passwords), [event.id for event in storage.history],
+            storage.base.event.id if storage.base.event is not None else None,
+            list(storage.base.folded) if storage.base.folded is not None else None)
+
+
+def add_old_events(storage, device="local"):
+    # an entry with a few edits, all older than any retention period
+    events = [AddEvent([], "old", Password("old", "user", storage.seal("secret")), OLD_TIME, clock=1, device=device)]
+    events += [EditEvent([], "old", "comment", "edit {}".format(clock), OLD_TIME + clock, clock=clock, device=device)
+               for clock in range(2, 6)]
+    for event in events:
+        storage.history.append(event)
+        event.apply(storage)
+    storage.take_checkpoint()
+    return events
+
+
+def other_storage(storage, history):
+    other = Storage()
+    other.session = storage.session
+    other.history = history
+    return other
+
+
+# (name, key, clock) of the local edits and of the remote ones merged one after another. The first remote edit of
+# each commutes with the local ones after it and is put into the middle of the history
+MERGE_CASES = [
+    ([("entry0", "comment", clock) for clock in range(2, 6)], [("entry0", "password2", 2), ("entry0", "comment", 4)]),
+    ([("entry0", "comment", clock) for clock in range(2, 6)], [("entry0", "password2", 2), ("entry0", "username", 4)])
+]
+
+
+def random_merge_cases(runs=200, events=10, merges=5, seed=0):
+    # remote edits from earlier clocks land in the middle of the local history
+    rng = random.Random(seed)
+    keys = ("username", "password", "password2", "comment")
+    for _ in range(runs):
+        local_edits = [("entry{}".format(rng.randrange(3)), rng.choice(keys), clock) for clock in range(2, events + 2)]
+        remote_edits = [("entry{}".format(rng.randrange(3)), rng.choice(keys), rng.randint(2, events + 1))
+                        for _ in range(merges)]
+        yield local_edits, remote_edits
+
+
+def check_merge_matches_replay(local_edits, remote_edits):
+    storage = new_storage()
+    adds = [AddEvent([], "entry{}".format(i), Password("entry{}".format(i), "user", storage.seal("secret")),
+                     OLD_TIME, clock=1, device="local") for i in range(3)]
+    for event in adds + [EditEvent([], name, key, storage.seal("local {}".format(clock)), OLD_TIME + clock,
+                                   clock=clock, device="local") for name, key, clock in local_edits]:
+        storage.history.append(event)
+        event.apply(storage)
+    storage.take_checkpoint()
+
+    for merge, (name, key, clock) in enumerate(remote_edits):
+        storage.merge(other_storage(storage, adds + [EditEvent(
+            [], name, key, storage.seal("remote {}".format(merge)), OLD_TIME + clock, clock=clock,
+            device="remote{}".format(merge))]))
+        assert merged_state(storage, storage.passwords) == merged_state(storage, replay({}, storage.history).passwords), \
+            "differs from a full replay after merge {} of {}".format(merge + 1, (local_edits, remote_edits))
+
+
+def assert_merge_refused(storage, history):
+    try:
+        storage.merge(other_storage(storage, history))
+    except exceptions.PwdSyncException:
+        return
+    raise AssertionError("merged changes from before the base that were missing")
+
+
+def test_merges_match_replay():
+    for local_edits, remote_edits in MERGE_CASES + list(random_merge_cases()):
+        check_merge_matches_replay(local_edits, remote_edits)
+
+
+def test_compact_refuses_unknown_changes_before_base():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "passwords")
+        storage = new_storage(path)
+        events = add_old_events(storage)
+        assert storage.compact(30) == len(events)
+        assert storage.history == [] and storage.base.event is events[-1]
+        assert all(storage.base.is_folded(event.id) for event in events)
+
+        # the other side still has the compacted events, which are known here
+        assert storage.merge(other_storage(storage, list(events))).new_remote == 0
+        # an edit from before the base that never was here can't be put in front of it anymore
+        unknown = EditEvent([], "old", "username", "remote", OLD_TIME + 3, clock=3, device="remote")
+        assert_merge_refused(storage, events + [unknown])
+
+        # the folded ids are saved with the base
+        storage.save_data(path)
+        loaded = new_storage(path)
+        assert list(loaded.base.folded) == list(storage.base.folded)
+        assert_merge_refused(loaded, events + [unknown])
+        assert loaded.merge(other_storage(loaded, list(events))).new_remote == 0
+
+
+def test_save_log_load_compact_round_trip():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "passwords")
+        log_path = path + LOG_SUFFIX
+        storage = new_storage(path)
+        add_old_events(storage)
+        storage.add_pwd(Password("new", "user", "secret", "secret2", "comment"), "category")
+        storage.save_data(path)
+        assert not os.path.exists(log_path)
+
+        # saves after the snapshot only append their events to the log
+        size = os.path.getsize(path)
+        log_sizes = []
+        for i in range(2):
+            storage.edit_pwd("comment", "edit {}".format(i), "category", "new")
+            storage.save_data(path)
+            log_sizes.append(os.path.getsize(log_path))
+        assert os.path.getsize(path) == size and log_sizes[0] < log_sizes[1]
+
+        loaded = new_storage(path)
+        assert saved_state(loaded) == saved_state(storage)
+        assert loaded.log.count == 2 and not loaded.needs_snapshot
+
+        assert loaded.compact(30) == 5
+        loaded.save_data(path)
+        assert not os.path.exists(log_path)
+        compacted = new_storage(path)
+        assert saved_state(compacted) == saved_state(loaded)
+        assert len(compacted.history) == 3 and len(compacted.base.folded) == 5
+
+        compacted.edit_pwd("password", "changed", "old")
+        compacted.save_data(path)
+        loaded = new_storage(path)
+        assert saved_state(loaded) == saved_state(compacted)
+        assert loaded.reveal(loaded.get_pwd("old")) == "changed"
+
+
+def test_save_after_merging_changed_file():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "passwords")
+        storage = new_storage(path)
+        storage.add_pwd(Password("first", "user", "secret"))
+        storage.save_data(path)
+        other = new_storage(path)
+        other.add_pwd(Password("other", "user", "secret"))
+        other.save_data(path)
+
+        storage.add_pwd(Password("local", "user", "secret"))
+        try:
+            storage.save_data(path)
+        except exceptions.PwdSyncException:
+            pass
+        else:
+            raise AssertionError("overwrote the changes of another instance")
+        # once the changed file is merged in, saving replaces it
+        assert storage.merge(new_storage(path)).new_remote == 1
+        storage.save_data(path)
+        assert sorted(new_storage(path).passwords) == ["first", "local", "other"]
+
+
+def test_vault_format():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "passwords")
+        storage = new_storage(path)
+        add_old_events(storage)
+        storage.compact(30)
+        storage.add_pwd(Password("new", "user", "secret"), "category")
+        storage.save_data(path)
+        storage.edit_pwd("comment", "appended", "category", "new")
+        storage.save_data(path)
+
+        with open(path, "rb") as f:
+            assert f.read(len(crypto.MAGIC)) == crypto.MAGIC
+            f.seek(0)
+            records = [json.loads(line) for line in read_lines(crypto.VaultReader(f, storage.session))]
+        assert [record[0] for record in records] == [RECORD_BASE_EVENT, RECORD_BASE_FOLDED, RECORD_BASE_PASSWORD,
+                                                     RECORD_HISTORY, RECORD_PASSWORD, RECORD_PASSWORD]
+        assert records[0][1] == storage.base.event.to_json()
+        assert list(decode_folded(records[1][1])) == list(storage.base.folded)
+        # passwords are stored under their categories, the name is part of the password
+        assert records[2][1:] == ["", storage.base.passwords["old"].to_json()]
+        assert records[3][1] == storage.history[0].to_json()
+        assert sorted((record[1], record[2]["name"]) for record in records[4:]) == [("", "old"), ("category", "new")]
+        # secrets are sealed inside the encrypted records
+        assert "secret" not in json.dumps(records)
+
+        with open(path + LOG_SUFFIX, "rb") as f:
+            assert f.read(len(LOG_MAGIC)) == LOG_MAGIC
+        assert [event.to_json() for event in new_storage(path).history] == \
+            [event.to_json() for event in storage.history]
+
+
+def main():
+    failed = 0
+    tests = [value for name, value in sorted(globals().items()) if name.startswith("test_")]
+    for test in tests:
+        try:
+            test()
+        except Exception:
+            failed += 1
+            print("FAILED", test.__name__)
+            traceback.print_exc()
+        else:
+            print("ok", test.__name__)
+    print("{} of {} checks failed".format(failed, len(tests)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()